@@ -0,0 +1,89 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StageTimeout(TimeoutError):
+    def __init__(self, stage: str, seconds: float):
+        super().__init__(f"{stage} did not finish within {seconds}s")
+        self.stage = stage
+        self.seconds = seconds
+
+
+def run_sync(coroutine):
+    # Entry point of the synchronous wrappers. Inside a running event loop (a notebook, an async server)
+    # the coroutine gets its own loop on a helper thread instead of failing.
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="run-sync") as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def drive(coroutine):
+    # Runs a coroutine that never suspends, i.e. one that only awaits synchronous driver calls, to completion
+    # without an event loop; needed inside callbacks the synchronous driver calls, such as with_transaction.
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+    coroutine.close()
+    raise RuntimeError("coroutine suspended outside of an event loop")
+
+
+async def with_timeout(awaitable, seconds, stage: str):
+    # seconds=None waits indefinitely; a timeout cancels the stage and is reported with its name.
+    if seconds is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, seconds)
+    except asyncio.TimeoutError:
+        raise StageTimeout(stage, seconds) from None
+
+
+async def gather_or_cancel(*awaitables):
+    # Like asyncio.gather, but the first failure (or a cancellation of the caller) cancels the others.
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def ainvoke_model(model, messages):
+    # LangChain chat models all provide ainvoke; plain models with only invoke run on a worker thread.
+    if hasattr(model, "ainvoke"):
+        return await model.ainvoke(messages)
+    return await asyncio.to_thread(model.invoke, messages)
+
+
+async def astream_model(model, messages):
+    if hasattr(model, "astream"):
+        async for chunk in model.astream(messages):
+            yield chunk
+        return
+    # A synchronous stream is read on a worker thread and handed over chunk by chunk.
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    finished = object()
+
+    def produce():
+        try:
+            for chunk in model.stream(messages):
+                loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            loop.call_soon_threadsafe(chunks.put_nowait, finished)
+        except BaseException as e:
+            loop.call_soon_threadsafe(chunks.put_nowait, e)
+
+    producer = loop.run_in_executor(None, produce)
+    while True:
+        chunk = await chunks.get()
+        if chunk is finished:
+            break
+        if isinstance(chunk, BaseException):
+            raise chunk
+        yield chunk
+    await producer
@@ -0,0 +1,309 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from treeGenerator import CombinedMedicalTreeGenerator
+from fake_model import FakeChatModel
+from metrics import get_tracer
+from progress import NullProgress
+from async_support import ainvoke_model, astream_model
+from tree_export import load_tree
+from subtree_library import SQLiteSubtreeLibrary, MongoSubtreeLibrary
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OWNER_ID = "679fc806c5dab815f7995fb8"
+DEFAULT_PROVIDER_LIMITS = {"gemini": 4, "fake": 16}
+
+STATUS_PENDING = "pending"
+STATUS_GENERATED = "generated"
+STATUS_PUBLISHED = "published"
+STATUS_FAILED = "failed"
+# Generated and saved, but publishing failed; the next run publishes the saved tree again.
+STATUS_PUBLISH_FAILED = "publish_failed"
+
+
+class ConcurrencyLimitedModel:
+    # Wraps a chat model so that every call holds a slot of its provider's semaphore. Async callers wait for
+    # a slot on the provider's own waiter threads, so waiting never takes threads from the event loop's executor.
+    def __init__(self, model, semaphore, waiters):
+        self.model = model
+        self.semaphore = semaphore
+        self.waiters = waiters
+
+    def invoke(self, messages):
+        with self.semaphore:
+            return self.model.invoke(messages)
+
+    def stream(self, messages):
+        with self.semaphore:
+            yield from self.model.stream(messages)
+
+    async def _acquire(self):
+        # The waiter thread cannot be interrupted; if the call is cancelled first, whichever side comes
+        # second (the thread getting the slot, or the cancellation) gives the slot back.
+        lock = threading.Lock()
+        state = {"acquired": False, "cancelled": False}
+
+        def acquire():
+            self.semaphore.acquire()
+            with lock:
+                if state["cancelled"]:
+                    self.semaphore.release()
+                else:
+                    state["acquired"] = True
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.waiters, acquire)
+        except asyncio.CancelledError:
+            with lock:
+                state["cancelled"] = True
+                if state["acquired"]:
+                    self.semaphore.release()
+            raise
+
+    async def ainvoke(self, messages):
+        await self._acquire()
+        try:
+            return await ainvoke_model(self.model, messages)
+        finally:
+            self.semaphore.release()
+
+    async def astream(self, messages):
+        await self._acquire()
+        try:
+            async for chunk in astream_model(self.model, messages):
+                yield chunk
+        finally:
+            self.semaphore.release()
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+class BatchState:
+    # Job states persisted as one JSON file; rewritten atomically after every change.
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.jobs = json.load(f)
+
+    def get(self, job_id) -> dict:
+        with self._lock:
+            return dict(self.jobs.get(job_id, {"status": STATUS_PENDING}))
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            self.jobs.setdefault(job_id, {"status": STATUS_PENDING}).update(fields, updated_at=time.time())
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.jobs, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+def load_manifest(path) -> list:
+    # Accepts either a JSON list of jobs or JSON Lines with one job per line.
+    with open(path) as f:
+        content = f.read()
+    if content.lstrip().startswith("["):
+        jobs = json.loads(content)
+    else:
+        jobs = [json.loads(line) for line in content.splitlines() if line.strip()]
+    for index, job in enumerate(jobs):
+        job.setdefault("id", job.get("tree_name") or f"job-{index}")
+        job.setdefault("tree_name", job["id"])
+        job.setdefault("provider", "gemini")
+        job.setdefault("owner_id", DEFAULT_OWNER_ID)
+        if isinstance(job.get("diseases"), str):
+            job["diseases"] = [d.strip() for d in job["diseases"].split(",") if d.strip()]
+    return jobs
+
+
+class BatchRunner:
+    def __init__(self, state_path="batch_state.json", checkpoint_dir="batch_trees", max_workers=4,
+                 provider_limits=None, model_factories=None, publish=True, cache=None, client=None,
+                 convergence_threshold=None, compact_prompts=False, result_fanout=False, tracer=None,
+                 tree_format="ndjson", subtree_library=None, share_branches=False, requests_per_minute=None,
+                 tokens_per_minute=None):
+        self.state = BatchState(state_path)
+        self.checkpoint_dir = checkpoint_dir
+        self.max_workers = max_workers
+        limits = dict(DEFAULT_PROVIDER_LIMITS, **(provider_limits or {}))
+        self.semaphores = {provider: threading.BoundedSemaphore(limit) for provider, limit in limits.items()}
+        self.slot_waiters = {provider: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"{provider}-slots")
+                             for provider, limit in limits.items()}
+        self.model_factories = {"fake": FakeChatModel}
+        self.model_factories.update(model_factories or {})
+        self.publish = publish
+        self.cache = cache
+        self.client = client
+        self.convergence_threshold = convergence_threshold
+        self.compact_prompts = compact_prompts
+        self.result_fanout = result_fanout
+        self.tree_format = tree_format
+        self.subtree_library = subtree_library
+        self.share_branches = share_branches
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.tracer = tracer if tracer is not None else get_tracer()
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def safe_job_id(self, job_id) -> str:
+        return "".join(c if c.isalnum() or c in "-_." else "_" for c in job_id)
+
+    def tree_path(self, job_id) -> str:
+        return os.path.join(self.checkpoint_dir, f"{self.safe_job_id(job_id)}.{self.tree_format}")
+
+    def build_generator(self, job) -> CombinedMedicalTreeGenerator:
+        provider = job["provider"]
+        # Only gemini is built by the generator itself; any other provider needs a limit and a model factory.
+        factory = self.model_factories.get(provider)
+        if provider not in self.semaphores or (factory is None and provider != "gemini"):
+            raise ValueError(f"unknown provider {provider!r}; known providers: {', '.join(sorted(self.semaphores))}")
+        generator = CombinedMedicalTreeGenerator(job["file_type"], job["diseases"], cache=self.cache,
+                                                 model=factory() if factory else None,
+                                                 convergence_threshold=job.get("convergence_threshold", self.convergence_threshold),
+                                                 compact_prompts=job.get("compact_prompts", self.compact_prompts),
+                                                 result_fanout=job.get("result_fanout", self.result_fanout),
+                                                 checkpoint_dir=os.path.join(self.checkpoint_dir, "iterations"),
+                                                 job_key=self.safe_job_id(job["id"]), tracer=self.tracer,
+                                                 subtree_library=self.subtree_library,
+                                                 share_branches=job.get("share_branches", self.share_branches),
+                                                 requests_per_minute=self.requests_per_minute,
+                                                 tokens_per_minute=self.tokens_per_minute)
+        generator.model = ConcurrencyLimitedModel(generator.model, self.semaphores[provider], self.slot_waiters[provider])
+        return generator
+
+    def generate(self, job) -> list:
+        generator = self.build_generator(job)
+        tree = generator.run(NullProgress(), NullProgress())
+        generator.export_tree(tree, self.tree_path(job["id"]))
+        self.state.update(job["id"], status=STATUS_GENERATED, tree_file=self.tree_path(job["id"]), nodes=len(tree),
+                          rounds_used=generator.rounds_used, prompt_stats=generator.prompt_stats(), run_id=generator.run_id)
+        return tree
+
+    def publish_tree(self, job, tree):
+        from custom2doctreen_parser import CustomToDoctreenConverter
+        from mongo_connection import get_client
+        from config import mongo_uri
+        client = self.client if self.client is not None else get_client(mongo_uri())
+        converter = CustomToDoctreenConverter(job["owner_id"], job["tree_name"], client=client, tracer=self.tracer,
+                                              subtree_library=self.subtree_library)
+        # Jobs with update_tree_id republish into that tree, keeping the nodeIds of unchanged nodes.
+        _, tree_doc, link = converter.convert_custom_to_doctreen(tree, tree_id=job.get("update_tree_id"))
+        self.state.update(job["id"], status=STATUS_PUBLISHED, tree_id=str(tree_doc["_id"]), link=link, publish_error=None)
+
+    def run_job(self, job) -> dict:
+        job_id = job["id"]
+        state = self.state.get(job_id)
+        if state["status"] == STATUS_PUBLISHED or (state["status"] in (STATUS_GENERATED, STATUS_PUBLISH_FAILED) and not self.publish):
+            logger.info("[%s] already %s, skipping", job_id, state["status"])
+            return state
+        started = time.time()
+        try:
+            # Any saved tree is reused, including one whose publishing failed, so it is never generated twice.
+            if state.get("tree_file") and os.path.exists(state["tree_file"]):
+                logger.info("[%s] resuming from checkpointed tree", job_id)
+                # The format is detected from the file, so trees saved as plain JSON still resume.
+                tree = load_tree(state["tree_file"])
+            else:
+                self.state.update(job_id, status=STATUS_PENDING, error=None)
+                tree = self.generate(job)
+        except Exception as e:
+            self.state.update(job_id, status=STATUS_FAILED, error=f"{type(e).__name__}: {e}")
+            logger.error("[%s] failed: %s", job_id, e)
+            return self.state.get(job_id)
+        if self.publish:
+            try:
+                self.publish_tree(job, tree)
+            except Exception as e:
+                # The generation result (tree_file, stats) is kept; only the publish error is recorded.
+                self.state.update(job_id, status=STATUS_PUBLISH_FAILED, publish_error=f"{type(e).__name__}: {e}")
+                logger.error("[%s] publishing failed: %s", job_id, e)
+                return self.state.get(job_id)
+        logger.info("[%s] done in %.1fs", job_id, time.time() - started)
+        return self.state.get(job_id)
+
+    def run(self, jobs) -> dict:
+        with self.tracer.span("batch", jobs=len(jobs)) as span:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(self.run_job, job): job["id"] for job in jobs}
+                for future in as_completed(futures):
+                    future.result()
+            summary = {}
+            for job in jobs:
+                status = self.state.get(job["id"])["status"]
+                summary[status] = summary.get(status, 0) + 1
+            span["statuses"] = summary
+        logger.info("Batch finished: %s", summary)
+        logger.info("Stage timings: %s", self.tracer.summary())
+        if self.subtree_library is not None:
+            logger.info("Subtree library stats: %s", self.subtree_library.stats())
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate (and optionally publish) many trees from a job manifest.")
+    parser.add_argument("manifest", help="JSON list or JSON Lines file of jobs (file_type, diseases, tree_name, provider, update_tree_id)")
+    parser.add_argument("--state", default="batch_state.json", help="job state file used to resume a crashed batch")
+    parser.add_argument("--checkpoint-dir", default="batch_trees", help="where generated trees are kept until published")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--provider-limit", action="append", default=[], metavar="PROVIDER=N",
+                        help="maximum concurrent model calls for a provider, e.g. gemini=2")
+    parser.add_argument("--fake-model", action="store_true", help="run every job against the offline fake model")
+    parser.add_argument("--no-publish", action="store_true", help="only generate trees, do not write to MongoDB")
+    parser.add_argument("--convergence-threshold", type=float, default=None,
+                        help="skip remaining refinement rounds once node growth per round drops below this ratio")
+    parser.add_argument("--compact-prompts", action="store_true",
+                        help="send a condensed outline of the previous round and merge back only the additions")
+    parser.add_argument("--result-fanout", action="store_true",
+                        help="refine each top-level RESULT branch in its own concurrent model call")
+    parser.add_argument("--trace-file", default=None, help="append one JSON line per pipeline span to this file")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve Prometheus metrics on this local port")
+    parser.add_argument("--tree-format", choices=("ndjson", "msgpack", "json"), default="ndjson",
+                        help="file format of the generated trees handed from generation to publishing")
+    parser.add_argument("--subtree-library", default=None,
+                        help="SQLite file of shared subtrees reused across trees, or 'mongo' for the collection next to the trees")
+    parser.add_argument("--share-branches", action="store_true",
+                        help="with --result-fanout and --subtree-library, reuse a RESULT branch expansion for any exam "
+                             "with the same branch outline instead of only for the same exam and diseases")
+    parser.add_argument("--requests-per-minute", type=float, default=None,
+                        help="model requests per minute shared by all jobs (default: config, then 60)")
+    parser.add_argument("--tokens-per-minute", type=float, default=None,
+                        help="model tokens per minute shared by all jobs (default: config, then 1000000)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    provider_limits = {}
+    for limit in args.provider_limit:
+        provider, _, value = limit.partition("=")
+        provider_limits[provider] = int(value)
+    jobs = load_manifest(args.manifest)
+    if args.fake_model:
+        for job in jobs:
+            job["provider"] = "fake"
+    tracer = get_tracer("batch", path=args.trace_file, prometheus_port=args.metrics_port)
+    subtree_library = None
+    if args.subtree_library == "mongo":
+        from mongo_connection import get_client
+        from config import mongo_uri
+        subtree_library = MongoSubtreeLibrary(get_client(mongo_uri()))
+    elif args.subtree_library:
+        subtree_library = SQLiteSubtreeLibrary(args.subtree_library)
+    runner = BatchRunner(args.state, args.checkpoint_dir, args.workers, provider_limits, publish=not args.no_publish,
+                         convergence_threshold=args.convergence_threshold, compact_prompts=args.compact_prompts,
+                         result_fanout=args.result_fanout, tracer=tracer, tree_format=args.tree_format,
+                         subtree_library=subtree_library, share_branches=args.share_branches,
+                         requests_per_minute=args.requests_per_minute, tokens_per_minute=args.tokens_per_minute)
+    runner.run(jobs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from treeGenerator import CombinedMedicalTreeGenerator
+from fake_model import FakeChatModel, RecordedChatModel
+from batch_runner import DEFAULT_OWNER_ID
+from progress import NullProgress
+from metrics import Tracer
+
+HEAVY_MODULES = ("streamlit", "graphviz", "langchain", "langchain_google_genai", "pymongo", "bson")
+COLD_START_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import treeGenerator, custom2doctreen_parser, batch_runner
+seconds = time.perf_counter() - started
+print(json.dumps({"seconds": seconds, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+STAGE_ORDER = ("generate", "llm_round", "parse", "dedup", "fuse", "convert", "id_generation", "mongo_write")
+
+
+class RecordingTracer(Tracer):
+    # Keeps every span duration so percentiles can be computed, and the peak memory of each
+    # span while tracemalloc is running (spans of concurrent threads share the same peak).
+    def __init__(self):
+        super().__init__()
+        self.durations = {}
+        self.peaks = {}
+        self.outer_peak = 0
+
+    @contextmanager
+    def track_memory(self, name):
+        if not tracemalloc.is_tracing():
+            yield
+            return
+        start, peak = tracemalloc.get_traced_memory()
+        # Resetting the peak for this span must not lose the peak of the span around it.
+        saved = max(self.outer_peak, peak)
+        self.outer_peak = 0
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            peak = max(self.outer_peak, tracemalloc.get_traced_memory()[1])
+            self.record_peak(name, peak - start)
+            self.outer_peak = max(saved, peak)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        with self.track_memory(name):
+            with super().span(name, **attributes) as values:
+                yield values
+
+    def record(self, name, seconds, **attributes):
+        super().record(name, seconds, **attributes)
+        with self._lock:
+            self.durations.setdefault(name, []).append(seconds)
+
+    def record_peak(self, name, peak):
+        with self._lock:
+            self.peaks[name] = max(self.peaks.get(name, 0), peak)
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def make_model(args):
+    if args.recorded:
+        return RecordedChatModel.from_file(args.recorded, latency=args.latency)
+    return FakeChatModel(breadth=args.breadth, depth=args.depth, latency=args.latency, seed=args.seed)
+
+
+def make_client(args):
+    if args.mongo_uri:
+        from mongo_connection import get_client
+        return get_client(args.mongo_uri)
+    try:
+        import mongomock
+    except ImportError:
+        return None
+    return mongomock.MongoClient()
+
+
+def run_once(args, tracer, client, index):
+    generator = CombinedMedicalTreeGenerator(args.file_type, args.diseases, model=make_model(args), tracer=tracer)
+    started = time.perf_counter()
+    with tracer.track_memory("generate"):
+        tree = generator.run(NullProgress(), NullProgress())
+    result = {"nodes": len(tree), "generate_seconds": time.perf_counter() - started}
+    if client is not None:
+        from custom2doctreen_parser import CustomToDoctreenConverter
+        # mongomock has no transactions, so only a real server exercises the atomic publish path.
+        converter = CustomToDoctreenConverter(DEFAULT_OWNER_ID, f"benchmark-{index}", client=client, tracer=tracer,
+                                              atomic_publish=bool(args.mongo_uri))
+        started = time.perf_counter()
+        with tracer.track_memory("convert"):
+            new_nodes, tree_doc, _ = converter.convert_custom_to_doctreen(tree)
+        result["convert_seconds"] = time.perf_counter() - started
+        # Benchmark trees are removed again so repeated runs do not grow the database.
+        converter.rollback(new_nodes, tree_doc["_id"])
+    return result
+
+
+def run_benchmark(args) -> dict:
+    client = None if args.no_convert else make_client(args)
+    if client is None and not args.no_convert:
+        print("mongomock is not installed and no --mongo-uri was given, skipping the converter stages")
+    tracer = RecordingTracer()
+    runs = [run_once(args, tracer, client, index) for index in range(args.repeat)]
+    if args.memory:
+        # A separate traced run, since tracemalloc slows everything down and would skew the timings.
+        memory_tracer = RecordingTracer()
+        tracemalloc.start()
+        try:
+            run_once(args, memory_tracer, client, args.repeat)
+        finally:
+            tracemalloc.stop()
+        peaks = memory_tracer.peaks
+    else:
+        peaks = {}
+    stages = {}
+    for name in STAGE_ORDER:
+        durations = tracer.durations.get(name)
+        if not durations:
+            continue
+        totals = tracer.totals[name]
+        stages[name] = {
+            "count": len(durations),
+            "p50": round(percentile(durations, 0.5), 6),
+            "p95": round(percentile(durations, 0.95), 6),
+            "max": round(max(durations), 6),
+            "total": round(sum(durations), 6),
+            "peak_kib": round(peaks[name] / 1024, 1) if name in peaks else None,
+        }
+        for attribute in ("nodes", "documents"):
+            if totals.get(attribute):
+                stages[name]["per_second"] = round(totals[attribute] / max(sum(durations), 1e-9), 1)
+                break
+    return {
+        "config": {"file_type": args.file_type, "breadth": args.breadth, "depth": args.depth,
+                   "latency": args.latency, "repeat": args.repeat, "recorded": args.recorded},
+        "nodes": runs[-1]["nodes"],
+        "stages": stages,
+    }
+
+
+def cold_start(repeat: int) -> dict:
+    # Each sample is a fresh interpreter importing the pipeline modules, without any secrets configured.
+    env = {name: value for name, value in os.environ.items() if not name.startswith("DOCTREEN_")}
+    samples = []
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", COLD_START_SCRIPT], capture_output=True, text=True, check=True,
+                                env=env, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        sample = json.loads(output.strip().splitlines()[-1])
+        samples.append(sample["seconds"])
+        loaded = sample["loaded"]
+    return {"p50": round(percentile(samples, 0.5), 6), "max": round(max(samples), 6), "heavy_modules_loaded": loaded}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, stage in results["stages"].items():
+        previous = baseline.get("stages", {}).get(name)
+        if previous is None or previous["p50"] <= 0:
+            continue
+        change = stage["p50"] / previous["p50"] - 1
+        stage["p50_change"] = round(change, 3)
+        if change > tolerance:
+            regressions.append(f"{name}: p50 {previous['p50']:.6f}s -> {stage['p50']:.6f}s ({change:+.0%})")
+    if baseline.get("nodes") is not None and baseline["nodes"] != results["nodes"]:
+        regressions.append(f"node count changed: {baseline['nodes']} -> {results['nodes']}")
+    return regressions
+
+
+def print_report(results: dict):
+    print(f"{'stage':<15}{'count':>7}{'p50 ms':>11}{'p95 ms':>11}{'max ms':>11}{'per s':>12}{'peak KiB':>11}{'vs base':>9}")
+    for name, stage in results["stages"].items():
+        peak = "" if stage["peak_kib"] is None else f"{stage['peak_kib']:.1f}"
+        change = f"{stage['p50_change']:+.0%}" if "p50_change" in stage else ""
+        print(f"{name:<15}{stage['count']:>7}{stage['p50'] * 1000:>11.3f}{stage['p95'] * 1000:>11.3f}"
+              f"{stage['max'] * 1000:>11.3f}{stage.get('per_second', ''):>12}{peak:>11}{change:>9}")
+    print(f"nodes per tree: {results['nodes']}")
+    if "cold_start" in results:
+        cold = results["cold_start"]
+        print(f"cold start import: p50 {cold['p50'] * 1000:.1f} ms, max {cold['max'] * 1000:.1f} ms, "
+              f"heavy modules loaded: {', '.join(cold['heavy_modules_loaded']) or 'none'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of tree generation and conversion.")
+    parser.add_argument("--file-type", default="Thyroid ultrasound")
+    parser.add_argument("--diseases", default="Nodule Control, Echo Std, Thyroiditis")
+    parser.add_argument("--breadth", type=int, default=4, help="children per node of the synthetic trees")
+    parser.add_argument("--depth", type=int, default=4, help="levels below each section root of the synthetic trees")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per model call")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--recorded", default=None,
+                        help="JSON file of recorded section texts, or an iteration checkpoint file, to replay")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--mongo-uri", default=None, help="local mongod to write to instead of mongomock")
+    parser.add_argument("--no-convert", action="store_true", help="only benchmark tree generation")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip the traced peak memory run")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("--baseline", default=None, help="results file to compare against")
+    parser.add_argument("--cold-start", action="store_true", help="also time importing the pipeline modules in a fresh interpreter")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown before failing")
+    args = parser.parse_args()
+    args.diseases = [d.strip() for d in args.diseases.split(",") if d.strip()]
+
+    results = run_benchmark(args)
+    if args.cold_start:
+        results["cold_start"] = cold_start(args.repeat)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print("Regressions against baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,51 @@
+import base64
+import logging
+import uuid
 import streamlit as st
 # import json
 # from bson import json_util
 from treeGenerator import CombinedMedicalTreeGenerator
 from custom2doctreen_parser import CustomToDoctreenConverter
+from config import mongo_uri
+from mongo_connection import get_client
+from llm_cache import SQLiteLLMCache
+from metrics import Tracer
+from tree_render import TreeRenderer
+from subtree_library import SQLiteSubtreeLibrary
+
+logger = logging.getLogger(__name__)
+
+@st.cache_resource
+def get_llm_cache():
+    return SQLiteLLMCache("llm_cache.sqlite")
+
+@st.cache_resource
+def get_tracer():
+    return Tracer("traces.jsonl")
+
+@st.cache_resource
+def get_subtree_library():
+    return SQLiteSubtreeLibrary("subtree_library.sqlite")
+
+@st.cache_resource
+def get_renderer():
+    return TreeRenderer("render_cache", timeout=30, tracer=get_tracer())
+
+def show_previews(previews):
+    # Section previews are rendered while the tree is uploaded; one that is still running is skipped.
+    with st.expander("Tree preview"):
+        for section, future in previews.items():
+            try:
+                with open(future.result(timeout=5), "rb") as f:
+                    svg = base64.b64encode(f.read()).decode("ascii")
+            except Exception as e:
+                st.caption(f"{section}: preview not available ({type(e).__name__})")
+                continue
+            st.caption(section)
+            st.markdown(f'<img src="data:image/svg+xml;base64,{svg}" style="max-width: 100%;">', unsafe_allow_html=True)
+
 def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     doctreen_icon = "https://static.wixstatic.com/media/cb6226_4224827f5f13449ebb1ce7b71abbbc10%7Emv2.png/v1/fill/w_192%2Ch_192%2Clg_1%2Cusm_0.66_1.00_0.01/cb6226_4224827f5f13449ebb1ce7b71abbbc10%7Emv2.png"
     doctreen_logo = "https://static.wixstatic.com/media/cb6226_9226c5ad3a1a48e9abb5adbf8e8eb30a~mv2.png/v1/crop/x_53,y_0,w_1223,h_439/fill/w_291,h_104,fp_0.50_0.50,q_85,usm_0.66_1.00_0.01,enc_avif,quality_auto/Logo%20horizontal%20fond%20blanc.png"
     
@@ -24,6 +66,7 @@ def main():
     file_type = st.text_input("Enter file type (e.g., 'Thyroid ultrasound')", "Thyroid ultrasound")
     diseases_input = st.text_area("Enter diseases separated by commas", "Nodule Control, Echo Std, Thyroiditis")
     tree_name = st.text_input("Enter tree name", "")
+    update_tree_id = st.text_input("Existing tree id to update (leave empty to create a new tree)", "").strip()
     
     if st.button("Generate & Convert"):
         if not tree_name:
@@ -35,22 +78,36 @@ def main():
         st.info("Generating medical tree...")
         my_bar = st.progress(0,text = "Starting Generation")
         my_text = st.empty()
-        generator = CombinedMedicalTreeGenerator(file_type, disease_context)
+        llm_cache = get_llm_cache()
+        tracer = get_tracer()
+        # Checkpoints are per browser session: a retry in the same session resumes, while concurrent sessions
+        # with the same inputs never share (or clear) each other's file.
+        if "checkpoint_key" not in st.session_state:
+            st.session_state["checkpoint_key"] = uuid.uuid4().hex
+        generator = CombinedMedicalTreeGenerator(file_type, disease_context, cache=llm_cache, checkpoint_dir="checkpoints",
+                                                 job_key=st.session_state["checkpoint_key"], tracer=tracer)
         tree = generator.run(my_bar,my_text)
+        logger.info("LLM cache stats: %s", llm_cache.stats())
+        if generator.rate_limiter is not None:
+            logger.info("Rate limiter stats: %s", generator.rate_limiter.stats())
         st.success("Pipeline completed successfully.")
+        previews = get_renderer().submit_sections(tree, "svg", max_depth=3)
         st.info("Uploading into doctreen ")
         my_bar.empty()
 
         owner_id = "679fc806c5dab815f7995fb8"
         
         try:
-            converter = CustomToDoctreenConverter(owner_id, tree_name)
-            doctreen_nodes, _, link = converter.convert_custom_to_doctreen(tree)
+            converter = CustomToDoctreenConverter(owner_id, tree_name, client=get_client(mongo_uri(), check_health=True), tracer=tracer,
+                                                  subtree_library=get_subtree_library())
+            doctreen_nodes, _, link = converter.convert_custom_to_doctreen(tree, tree_id=update_tree_id or None)
+            logger.info("Stage timings: %s", tracer.summary())
             
             st.success("Conversion complete!")
             st.write(f"Total nodes inserted: {len(doctreen_nodes)}")
             st.warning(f"Please Log onto doctreen to view the tree",icon="⚠️")
             st.link_button("Click here to go to the generated tree",link)
+            show_previews(previews)
         except Exception as e:
             st.error(f"An error occurred: {e}")
 
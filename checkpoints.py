@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+import threading
+
+
+def fingerprint(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class IterationCheckpoints:
+    # Persists every completed refinement round of a job so a failed run can resume from the
+    # last good iteration. Each section records the fingerprint of the inputs it was built on;
+    # a section whose inputs changed is discarded instead of resumed.
+    def __init__(self, directory: str, job_key: str):
+        self.directory = directory
+        self.job_key = job_key
+        self.path = os.path.join(directory, f"{job_key}.json")
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.sections = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.sections = json.load(f)
+
+    def restore(self, section: str, context: str) -> list:
+        with self._lock:
+            entry = self.sections.get(section)
+            if entry is None or entry["context"] != context:
+                return []
+            return list(entry["iterations"])
+
+    def save(self, section: str, iteration: int, text: str, context: str):
+        with self._lock:
+            entry = self.sections.get(section)
+            if entry is None or entry["context"] != context:
+                entry = self.sections[section] = {"context": context, "iterations": []}
+            del entry["iterations"][iteration:]
+            entry["iterations"].append(text)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.sections, f)
+            os.replace(tmp_path, self.path)
+
+    def clear(self):
+        with self._lock:
+            self.sections = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
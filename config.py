@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+
+SECRETS_FILE_ENV = "DOCTREEN_SECRETS_FILE"
+DEFAULT_SECRETS_FILES = (".streamlit/secrets.toml", os.path.expanduser("~/.streamlit/secrets.toml"))
+
+_secrets = {}
+_secrets_lock = threading.Lock()
+
+
+def load_secrets_file(path: str) -> dict:
+    with open(path, "rb") as f:
+        if path.endswith(".json"):
+            return json.load(f)
+        import tomllib
+        return tomllib.load(f)
+
+
+def lookup(section: str, key: str):
+    # Resolution order: environment (e.g. DOCTREEN_GENERAL_API_KEY), then a secrets file, then st.secrets.
+    env_name = f"DOCTREEN_{section}_{key}".upper()
+    if env_name in os.environ:
+        return os.environ[env_name]
+    explicit = os.environ.get(SECRETS_FILE_ENV)
+    for path in ((explicit,) if explicit else DEFAULT_SECRETS_FILES):
+        if os.path.exists(path):
+            value = load_secrets_file(path).get(section, {}).get(key)
+            if value is not None:
+                return value
+    try:
+        import streamlit as st
+        return st.secrets[section][key]
+    except (ImportError, KeyError, FileNotFoundError):
+        pass
+    raise KeyError(f"secret {section}.{key} is not set; export {env_name} or add it to {explicit or DEFAULT_SECRETS_FILES[0]}")
+
+
+def get_secret(section: str, key: str):
+    # Secrets are resolved on first use, so importing a module never needs a secrets file.
+    with _secrets_lock:
+        if (section, key) not in _secrets:
+            _secrets[(section, key)] = lookup(section, key)
+        return _secrets[(section, key)]
+
+
+def api_key() -> str:
+    return get_secret("general", "api_key")
+
+
+def mongo_uri() -> str:
+    return get_secret("general", "uri")
+
+
+def get_setting(section: str, key: str, default=None):
+    # Like get_secret, for optional settings that fall back to a default when they are not set.
+    try:
+        return get_secret(section, key)
+    except KeyError:
+        return default
+
+
+def rate_limits() -> dict:
+    # [rate_limit] requests_per_minute / tokens_per_minute, or DOCTREEN_RATE_LIMIT_REQUESTS_PER_MINUTE etc.;
+    # None keeps the limiter's default.
+    limits = {}
+    for key in ("requests_per_minute", "tokens_per_minute"):
+        value = get_setting("rate_limit", key)
+        limits[key] = float(value) if value is not None else None
+    return limits
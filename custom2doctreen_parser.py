@@ -1,117 +1,185 @@
-# import json
-import uuid
-from bson import ObjectId
-import pymongo
+import asyncio
+import inspect
+import json
+import logging
+import threading
+import time
 from datetime import datetime
+from mongo_connection import get_client, is_async_driver, AwaitableCollection
+from async_support import run_sync, drive, with_timeout
+from id_allocator import get_allocator, allocator_stats, uuid4_string
+from metrics import get_tracer
+from config import mongo_uri
+from progress import default_ui
+from node_store import merkle_digest
+from subtree_library import KIND_SUBTREE, signature_key
 # from tqdm import tqdm
-import streamlit as st
 
-URI = st.secrets["general"]["uri"]
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+TRANSACTIONS_UNSUPPORTED = 20
+# Fields derived from the generated tree; anything else on a stored node (values, styling, labels) is left alone on update.
+GENERATED_FIELDS = ("nodeType", "fatherId", "alias", "childNodes", "ownerId", "disabled")
+# Fields edited in Doctreen rather than generated, with the values a new node starts with.
+CURATED_DEFAULTS = {"value": {}, "markTypes": {"MARK_SPACE": True}, "styling": {}, "labelId": None}
+# Only subtrees of this many nodes are indexed in the shared-subtree library.
+SHARED_SUBTREE_NODES = (3, 500)
+
+class ConversionCancelled(Exception):
+    pass
+
+def __getattr__(name):
+    # URI used to be read from st.secrets at import time; it is now resolved on first access.
+    if name == "URI":
+        return mongo_uri()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class CustomToDoctreenConverter:
-    def __init__(self, owner_id, tree_name, uri=URI):
+    def __init__(self, owner_id, tree_name, uri=None, bulk_insert=True, batch_size=200, max_insert_retries=5, atomic_publish=True, client=None, tracer=None, ui=None, subtree_library=None, stage_timeouts=None):
+        from bson import ObjectId
         self.owner_id = owner_id
+        self.owner_object_id = ObjectId(owner_id)
         self.tree_name = tree_name
-        self.client = pymongo.MongoClient(uri)
+        self.bulk_insert = bulk_insert
+        self.batch_size = batch_size
+        self.max_insert_retries = max_insert_retries
+        self.atomic_publish = atomic_publish
+        self.tracer = tracer if tracer is not None else get_tracer()
+        # Progress bars and messages go to Streamlit inside the app and are dropped or printed elsewhere.
+        self.ui = ui if ui is not None else default_ui()
+        # Published subtrees are indexed here, and new nodes copy the curated fields of a known identical subtree.
+        self.subtree_library = subtree_library
+        # Seconds allowed per stage ("id_generation", "mongo_write", "convert"). Calls on a synchronous client
+        # cannot be interrupted, so for it only "convert" applies, and only to aconvert.
+        self.stage_timeouts = dict(stage_timeouts or {})
+        # client may also be an asyncio client (PyMongo async or Motor, see get_async_client) for aconvert.
+        self.client = client if client is not None else get_client(uri or mongo_uri())
+        self.is_async = is_async_driver(self.client)
         self.db = self.client["doctreen"]
         self.treenodes_collection = self.db["treenodes"]
         self.trees_collection = self.db["trees"]
+        self.treenodes = AwaitableCollection(self.treenodes_collection)
+        self.trees = AwaitableCollection(self.trees_collection)
+        self.uuid_allocator = get_allocator(self.treenodes_collection, "nodeId", uuid4_string)
+        self.objectid_allocator = get_allocator(self.treenodes_collection, "_id", ObjectId)
+        self.tree_id_allocator = get_allocator(self.trees_collection, "_id", ObjectId, batch_size=8)
 
-    def generate_unique_uuid(self,stream_lit_loop,index,total):
-        attempts = 0
-        
-        while True:
-            new_uuid = str(uuid.uuid4())
-            attempts += 1
-            
-            if (self.treenodes_collection.find_one({"nodeId": new_uuid}) is None):
-                stream_lit_loop.progress(index/total,text=f"UUID for node {index} created")
-                return new_uuid
-            
-            else:
-                continue
+    def check_cancelled(self, cancelled):
+        # cancelled is set by aconvert when its timeout fires (or its caller is cancelled) while a worker thread
+        # converts on a synchronous client; the thread stops before its next write and rolls back.
+        if cancelled is not None and cancelled.is_set():
+            raise ConversionCancelled(f"conversion of {self.tree_name} was cancelled")
 
-    def generate_unique_objectid(self):
-        attempts = 0
-        
-        while True:
-            new_objid = ObjectId()
-            attempts += 1
-            
-            if (self.treenodes_collection.find_one({"_id": new_objid}) is None):
-                return new_objid
-            
-            else:
-                continue
+    async def _stage(self, name, awaitable):
+        if not self.is_async:
+            return await awaitable
+        return await with_timeout(awaitable, self.stage_timeouts.get(name), name)
 
-    def generate_unique_tree_id(self):
-        attempts = 0
-        
-        while True:
-            new_tree_id = ObjectId()
-            attempts += 1
-            
-            if (self.trees_collection.find_one({"_id": new_tree_id}) is None):
-                st.info(f"Unique _id created for the tree : {new_tree_id}")
-                return new_tree_id
-            
-            else:
-                continue
+    async def allocate(self, allocator, count):
+        return await self._stage("id_generation", allocator.aallocate_many(count))
 
-    def convert_custom_to_doctreen(self, custom_nodes):
-        new_nodes = []
-        tree_nodes = []
-        idMap = {}
-        root = ''
-        check = 0
-        my_bar = st.progress(0,"Generating UUIDs")
-        total = len(custom_nodes)
-        for index,node in enumerate(custom_nodes):
-            new_uuid = self.generate_unique_uuid(stream_lit_loop = my_bar,index = index+1,total = total)
-            idMap[node['id']] = new_uuid
-            
-            if node['nodeType'] == 'TYPE_ROOT' and check == 0:
-                root = new_uuid
-                check = 1
-                
-            elif node['nodeType'] == 'TYPE_ROOT' and check == 1:
-                return 'INVALID ROOT', 0
-        
-        my_bar.empty()
-        my_bar = st.progress(0,"Adding nodes to doctreen")
-        for index,node in enumerate(custom_nodes):
-            node_id = self.generate_unique_objectid()
-            tree_nodes.append(node_id)
-            
-            if node.get("nodeType", "") == 'TYPE_MEASURE':
-                nodetype = 'TYPE_MESURE'
-                
-            elif node.get("nodeType", "") in ['TYPE_TOPIC', 'TYPE_QUESTION']:
-                nodetype = 'TYPE_NODE'
-                
-            else:
-                nodetype = node.get("nodeType", "")
-            
-            new_node = {
-                "_id": node_id,
-                "nodeId": idMap[node['id']],
-                "nodeType": nodetype,
-                "fatherId": idMap[node['parent']['id']] if node.get("parent") else None,
-                "alias": node.get("text", ""),
-                "value": {},
-                "markTypes": {"MARK_SPACE": True},
-                "styling": {},
-                "ownerId": ObjectId(self.owner_id),
-                "childNodes": [idMap.get(child.get("id"), child.get("id")) for child in node.get("childs", [])],
-                "labelId": None,
-                "disabled": False
-            }
-            result = self.treenodes_collection.insert_one(new_node)
-            new_nodes.append(new_node)
-            my_bar.progress((index+1)/total,text = f"Inserted node with _id:{result.inserted_id}")
+    async def generate_unique_uuid(self,stream_lit_loop,index,total):
+        new_uuid = (await self.allocate(self.uuid_allocator, 1))[0]
+        stream_lit_loop.progress(index/total,text=f"UUID for node {index} created")
+        return new_uuid
+
+    async def generate_unique_objectid(self):
+        return (await self.allocate(self.objectid_allocator, 1))[0]
+
+    async def generate_unique_tree_id(self):
+        with self.tracer.span("id_generation", tree=self.tree_name, kind="tree_id", documents=1):
+            new_tree_id = (await self.allocate(self.tree_id_allocator, 1))[0]
+        self.ui.info(f"Unique _id created for the tree : {new_tree_id}")
+        return new_tree_id
+
+    def doctreen_node_type(self, node_type):
+        if node_type == 'TYPE_MEASURE':
+            return 'TYPE_MESURE'
+        if node_type in ['TYPE_TOPIC', 'TYPE_QUESTION']:
+            return 'TYPE_NODE'
+        return node_type
+
+    def build_node_document(self, node, idMap, node_id):
+        return {
+            "_id": node_id,
+            "nodeId": idMap[node['id']],
+            "nodeType": self.doctreen_node_type(node.get("nodeType", "")),
+            "fatherId": idMap[node['parent']['id']] if node.get("parent") else None,
+            "alias": node.get("text", ""),
+            "value": {},
+            "markTypes": {"MARK_SPACE": True},
+            "styling": {},
+            "ownerId": self.owner_object_id,
+            "childNodes": [idMap.get(child.get("id"), child.get("id")) for child in node.get("childs", [])],
+            "labelId": None,
+            "disabled": False
+        }
+
+    async def replace_node_uuid(self, old_uuid, new_uuid, new_nodes, idMap, inserted_ids, session=None):
+        # A regenerated nodeId must be propagated to every reference, including nodes already written.
+        for custom_id, mapped in idMap.items():
+            if mapped == old_uuid:
+                idMap[custom_id] = new_uuid
+        for doc in new_nodes:
+            if doc["nodeId"] == old_uuid:
+                doc["nodeId"] = new_uuid
+            if doc["fatherId"] == old_uuid:
+                doc["fatherId"] = new_uuid
+            doc["childNodes"] = [new_uuid if child == old_uuid else child for child in doc["childNodes"]]
+        if inserted_ids:
+            await self._stage("mongo_write", self.treenodes.update_many(
+                {"_id": {"$in": inserted_ids}, "fatherId": old_uuid}, {"$set": {"fatherId": new_uuid}}, session=session))
+            await self._stage("mongo_write", self.treenodes.update_many(
+                {"_id": {"$in": inserted_ids}, "childNodes": old_uuid}, {"$set": {"childNodes.$[child]": new_uuid}},
+                array_filters=[{"child": old_uuid}], session=session))
+
+    async def insert_batch(self, batch, new_nodes, idMap, inserted_ids, session=None):
+        from pymongo.errors import BulkWriteError
+        pending = batch
+        retries = 0
+        while pending:
+            try:
+                with self.tracer.span("mongo_write", tree=self.tree_name, collection="treenodes", documents=len(pending),
+                                      retry=retries, transaction=session is not None):
+                    await self._stage("mongo_write", self.treenodes.insert_many(pending, ordered=False, session=session))
+                inserted_ids.extend(doc["_id"] for doc in pending)
+                return retries
+            except BulkWriteError as e:
+                write_errors = e.details.get("writeErrors", [])
+                # A failed write aborts the transaction, so conflicts cannot be retried inside one.
+                if session is not None or retries >= self.max_insert_retries or any(err.get("code") != DUPLICATE_KEY_ERROR for err in write_errors):
+                    raise
+                retries += 1
+                failed_indexes = {err["index"] for err in write_errors}
+                inserted_ids.extend(doc["_id"] for i, doc in enumerate(pending) if i not in failed_indexes)
+                failed = []
+                for err in write_errors:
+                    doc = pending[err["index"]]
+                    if "nodeId" in err.get("keyPattern", {}) or "nodeId" in err.get("errmsg", ""):
+                        await self.replace_node_uuid(doc["nodeId"], await self.uuid_allocator.areplace_conflicting(), new_nodes, idMap, inserted_ids, session=session)
+                    else:
+                        doc["_id"] = await self.objectid_allocator.areplace_conflicting()
+                    failed.append(doc)
+                pending = failed
+        return retries
+
+    async def insert_nodes_in_batches(self, new_nodes, idMap, session=None, cancelled=None):
+        total = len(new_nodes)
+        inserted_ids = []
+        retries = 0
+        my_bar = self.ui.progress(0,"Adding nodes to doctreen")
+        for start in range(0, total, self.batch_size):
+            self.check_cancelled(cancelled)
+            batch = new_nodes[start:start + self.batch_size]
+            retries += await self.insert_batch(batch, new_nodes, idMap, inserted_ids, session=session)
+            done = start + len(batch)
+            my_bar.progress(done/total,text = f"Inserted batch {start//self.batch_size + 1} ({done}/{total} nodes)")
         my_bar.empty()
-        tree_id = self.generate_unique_tree_id()
-        tree_doc = {
+        logger.info("Inserted %d nodes with %d duplicate-key retries", len(inserted_ids), retries)
+
+    def build_tree_document(self, tree_id, tree_nodes, root):
+        return {
             "_id": tree_id,
             "treeName": self.tree_name,
             "tags": [],
@@ -128,13 +196,369 @@ class CustomToDoctreenConverter:
             "lastUpdate": datetime.utcnow(),
             "software_version": 1,
             "lineTreeId": tree_id,
-            "ownerId": ObjectId(self.owner_id),
+            "ownerId": self.owner_object_id,
             "rootNodeId": root
         }
+
+    async def write_tree(self, new_nodes, idMap, root_key, tree_id, session=None, cancelled=None):
+        await self.insert_nodes_in_batches(new_nodes, idMap, session=session, cancelled=cancelled)
+        self.check_cancelled(cancelled)
+        # Built after the nodes are written so that any regenerated IDs are picked up.
+        tree_doc = self.build_tree_document(tree_id, [doc["_id"] for doc in new_nodes], idMap.get(root_key, ''))
+        with self.tracer.span("mongo_write", tree=self.tree_name, collection="trees", documents=1, transaction=session is not None):
+            await self._stage("mongo_write", self.trees.insert_one(tree_doc, session=session))
+        return tree_doc
+
+    def rollback(self, new_nodes, tree_id):
+        return run_sync(self.arollback(new_nodes, tree_id))
+
+    async def arollback(self, new_nodes, tree_id=None):
+        # A network error can leave part of a batch written, so every _id we meant to write is removed.
+        # tree_id is None when the tree document was never written.
+        node_ids = [doc["_id"] for doc in new_nodes]
+        with self.tracer.span("rollback", tree=self.tree_name, documents=len(node_ids)):
+            result = await self.treenodes.delete_many({"_id": {"$in": node_ids}})
+            if tree_id is not None:
+                await self.trees.delete_one({"_id": tree_id})
+        logger.info("Rolled back %d nodes and tree %s", result.deleted_count, tree_id)
+
+    async def publish_atomically(self, new_nodes, idMap, root_key, tree_id, cancelled=None):
+        async def write(session=None):
+            if session is not None:
+                return await self.write_tree(new_nodes, idMap, root_key, tree_id, session=session, cancelled=cancelled)
+            try:
+                return await self.write_tree(new_nodes, idMap, root_key, tree_id, cancelled=cancelled)
+            except BaseException:
+                # Also undoes a write that was cancelled or timed out halfway.
+                await self.arollback(new_nodes, tree_id)
+                raise
+
+        return await self.run_in_transaction(write, "publishing with rollback on failure")
+
+    def structural_keys(self, labels, parents):
+        # Key of a node = the (text, type) labels on its path from the root plus an occurrence number,
+        # so siblings with the same label still get distinct keys. Both dicts are in document order.
+        paths = {}
+        for ident in labels:
+            chain = []
+            on_chain = set()
+            current = ident
+            while current is not None and current not in paths and current not in on_chain:
+                chain.append(current)
+                on_chain.add(current)
+                current = parents.get(current)
+            prefix = paths.get(current, ())
+            for item in reversed(chain):
+                prefix = prefix + (labels[item],)
+                paths[item] = prefix
+        keys = {}
+        occurrences = {}
+        for ident in labels:
+            occurrence = occurrences.get(paths[ident], 0)
+            occurrences[paths[ident]] = occurrence + 1
+            keys[ident] = (paths[ident], occurrence)
+        return keys
+
+    async def aload_tree(self, tree_id):
+        from bson import ObjectId
+        if isinstance(tree_id, str):
+            tree_id = ObjectId(tree_id)
+        tree_doc = await self.trees.find_one({"_id": tree_id})
+        if tree_doc is None:
+            raise ValueError(f"tree {tree_id} does not exist")
+        stored_nodes = await self.treenodes.find({"_id": {"$in": tree_doc["treeNodeIds"]}})
+        order = {node_id: index for index, node_id in enumerate(tree_doc["treeNodeIds"])}
+        stored_nodes.sort(key=lambda doc: order[doc["_id"]])
+        return tree_doc, stored_nodes
+
+    def plan_update(self, custom_nodes, stored_nodes):
+        # Matches regenerated nodes to stored ones by structural key, keeping their nodeId and _id.
+        stored_labels = {doc["nodeId"]: (doc.get("alias", ""), doc.get("nodeType", "")) for doc in stored_nodes}
+        stored_parents = {doc["nodeId"]: doc["fatherId"] if doc.get("fatherId") in stored_labels else None for doc in stored_nodes}
+        stored_by_key = {key: doc for doc, key in zip(stored_nodes, self.structural_keys(stored_labels, stored_parents).values())}
+        labels = {node["id"]: (node.get("text", ""), self.doctreen_node_type(node.get("nodeType", ""))) for node in custom_nodes}
+        parents = {node["id"]: node["parent"]["id"] if node.get("parent") and node["parent"]["id"] in labels else None for node in custom_nodes}
+        keys = self.structural_keys(labels, parents)
+        matched = {}
+        for node in custom_nodes:
+            doc = stored_by_key.pop(keys[node["id"]], None)
+            if doc is not None:
+                matched[node["id"]] = doc
+        # Whatever is left in stored_by_key no longer exists in the regenerated tree.
+        return matched, list(stored_by_key.values())
+
+    async def aupdate_tree(self, custom_nodes, tree_id, cancelled=None):
+        from pymongo import InsertOne, UpdateOne, DeleteMany
+        started = time.perf_counter()
+        tree_doc, stored_nodes = await self.aload_tree(tree_id)
+        tree_id = tree_doc["_id"]
+        matched, removed = self.plan_update(custom_nodes, stored_nodes)
+        fresh = [node for node in custom_nodes if node["id"] not in matched]
+        idMap = {node_id: doc["nodeId"] for node_id, doc in matched.items()}
+        with self.tracer.span("id_generation", tree=self.tree_name, kind="update", documents=len(fresh) * 2):
+            idMap.update(zip((node["id"] for node in fresh), await self.allocate(self.uuid_allocator, len(fresh))))
+            fresh_object_ids = dict(zip((node["id"] for node in fresh), await self.allocate(self.objectid_allocator, len(fresh))))
+        new_nodes = []
+        operations = []
+        unchanged = 0
+        for node in custom_nodes:
+            stored = matched.get(node["id"])
+            doc = self.build_node_document(node, idMap, stored["_id"] if stored is not None else fresh_object_ids[node["id"]])
+            new_nodes.append(doc)
+            if stored is None:
+                operations.append(InsertOne(doc))
+                continue
+            changes = {field: doc[field] for field in GENERATED_FIELDS if stored.get(field) != doc[field]}
+            if changes:
+                operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": changes}))
+            else:
+                unchanged += 1
+        if removed:
+            operations.append(DeleteMany({"_id": {"$in": [doc["_id"] for doc in removed]}}))
+        root = next((node["id"] for node in custom_nodes if node["nodeType"] == 'TYPE_ROOT'), '')
+        tree_update = {
+            "treeName": self.tree_name,
+            "treeNodeIds": [doc["_id"] for doc in new_nodes],
+            "rootNodeId": idMap.get(root, ''),
+            "lastUpdate": datetime.utcnow(),
+        }
+
+        async def write(session=None):
+            with self.tracer.span("mongo_write", tree=self.tree_name, collection="treenodes", kind="bulk_write",
+                                  documents=len(operations), transaction=session is not None):
+                if operations:
+                    await self._stage("mongo_write", self.treenodes.bulk_write(operations, ordered=False, session=session))
+                await self._stage("mongo_write", self.trees.update_one({"_id": tree_id}, {"$set": tree_update}, session=session))
+
+        # The update is a single bulk write, so it is either skipped here or applied whole.
+        self.check_cancelled(cancelled)
+        if self.atomic_publish:
+            await self.run_in_transaction(write, "applying the update without one")
+        else:
+            await write()
+        tree_doc.update(tree_update)
+        inserted = len(fresh)
+        updated = len(operations) - inserted - (1 if removed else 0)
+        logger.info("Updated tree %s: %d inserted, %d updated, %d deleted, %d unchanged", tree_id, inserted, updated, len(removed), unchanged)
+        self.tracer.record("update", time.perf_counter() - started, tree=self.tree_name, nodes=len(custom_nodes),
+                           inserted=inserted, updated=updated, deleted=len(removed), unchanged=unchanged)
+        return new_nodes, tree_doc
+
+    async def run_in_transaction(self, write, fallback):
+        # Awaits write(session=...) in a transaction, or write() on deployments without transactions.
+        from pymongo.errors import OperationFailure
+        try:
+            if self.is_async:
+                session = self.client.start_session()
+                # Motor's start_session is a coroutine; PyMongo's async client returns the session directly.
+                if inspect.isawaitable(session):
+                    session = await session
+                async with session:
+                    return await session.with_transaction(lambda s: write(session=s))
+            with self.client.start_session() as session:
+                # The synchronous driver expects a plain callback; write never suspends on a synchronous client.
+                return session.with_transaction(lambda s: drive(write(session=s)))
+        except NotImplementedError:
+            # In-memory clients such as mongomock have no sessions at all.
+            logger.warning("Sessions are not supported by this client, %s", fallback)
+            return await write()
+        except OperationFailure as e:
+            if e.code != TRANSACTIONS_UNSUPPORTED:
+                raise
+            logger.warning("Transactions are not supported by this deployment, %s", fallback)
+        return await write()
+
+    def subtree_digests(self, by_node_id):
+        # Merkle digest of (alias, nodeType, children) and node count of every subtree, children first.
+        digests = {}
+        sizes = {}
+        for start in by_node_id:
+            stack = [(start, False)]
+            visiting = set()
+            while stack:
+                node_id, ready = stack.pop()
+                if node_id in digests:
+                    continue
+                children = [child for child in by_node_id[node_id]["childNodes"] if child in by_node_id]
+                if not ready:
+                    visiting.add(node_id)
+                    stack.append((node_id, True))
+                    stack.extend((child, False) for child in children if child not in digests and child not in visiting)
+                    continue
+                visiting.discard(node_id)
+                # A child still being visited closes a cycle and is left out.
+                known = [child for child in children if child in digests]
+                doc = by_node_id[node_id]
+                digests[node_id] = merkle_digest(doc["alias"], doc["nodeType"], None, [digests[child] for child in known])
+                sizes[node_id] = 1 + sum(sizes[child] for child in known)
+        return digests, sizes
+
+    def subtree_members(self, by_node_id, node_id):
+        members = []
+        seen = set()
+        stack = [node_id]
+        while stack:
+            current = stack.pop()
+            if current in seen or current not in by_node_id:
+                continue
+            seen.add(current)
+            members.append(by_node_id[current])
+            stack.extend(reversed(by_node_id[current]["childNodes"]))
+        return members
+
+    def shared_subtrees(self, new_nodes):
+        # Library keys of every subtree of an indexable size, in document order.
+        by_node_id = {doc["nodeId"]: doc for doc in new_nodes}
+        digests, sizes = self.subtree_digests(by_node_id)
+        low, high = SHARED_SUBTREE_NODES
+        keys = {doc["nodeId"]: signature_key(KIND_SUBTREE, digests[doc["nodeId"]].hex())
+                for doc in new_nodes if low <= sizes[doc["nodeId"]] <= high}
+        return by_node_id, keys
+
+    async def reuse_known_subtrees(self, new_nodes):
+        # Seeds value, styling, marks and label of new nodes from the stored copy of an identical subtree,
+        # so curation done in Doctreen on one tree carries over to every later tree containing that branch.
+        from bson import ObjectId
+        by_node_id, keys = self.shared_subtrees(new_nodes)
+        known = self.subtree_library.get_many(KIND_SUBTREE, list(keys.values()))
+        matches = []
+        covered = set()
+        for node_id, key in keys.items():
+            if key not in known or node_id in covered:
+                continue
+            members = self.subtree_members(by_node_id, node_id)
+            covered.update(doc["nodeId"] for doc in members)
+            matches.append((members, [ObjectId(stored_id) for stored_id in json.loads(known[key])["nodes"]]))
+        if not matches:
+            return 0
+        stored_ids = [stored_id for _, ids in matches for stored_id in ids]
+        stored = {doc["_id"]: doc for doc in await self.treenodes.find({"_id": {"$in": stored_ids}})}
+        seeded = set()
+        saved = 0
+        for members, ids in matches:
+            sources = [stored.get(stored_id) for stored_id in ids]
+            # The stored subtree may have been edited or deleted since it was indexed.
+            if len(sources) != len(members) or any(source is None or (source.get("alias"), source.get("nodeType")) != (doc["alias"], doc["nodeType"])
+                                                   for doc, source in zip(members, sources)):
+                continue
+            for doc, source in zip(members, sources):
+                curated = {field: source[field] for field, default in CURATED_DEFAULTS.items()
+                           if field in source and source[field] != default}
+                # Deduplicated nodes can sit in several matched subtrees; each is seeded once.
+                if curated and doc["nodeId"] not in seeded:
+                    doc.update(curated)
+                    seeded.add(doc["nodeId"])
+                    saved += len(json.dumps(curated, default=str))
+        self.subtree_library.saved(KIND_SUBTREE, saved)
+        logger.info("Reused %d known subtrees, %d nodes seeded with curated fields", len(matches), len(seeded))
+        return len(seeded)
+
+    def register_subtrees(self, new_nodes, tree_id):
+        by_node_id, keys = self.shared_subtrees(new_nodes)
+        entries = {}
+        for node_id, key in keys.items():
+            if key not in entries:
+                members = self.subtree_members(by_node_id, node_id)
+                entries[key] = json.dumps({"tree": str(tree_id), "nodes": [str(doc["_id"]) for doc in members]})
+        self.subtree_library.put_many(KIND_SUBTREE, entries)
+        logger.info("Subtree library stats: %s", self.subtree_library.stats())
+
+    def convert_custom_to_doctreen(self, custom_nodes, tree_id=None, cancelled=None):
+        return run_sync(self._convert(custom_nodes, tree_id, cancelled))
+
+    async def aconvert(self, custom_nodes, tree_id=None):
+        timeout = self.stage_timeouts.get("convert")
+        if self.is_async:
+            return await with_timeout(self._convert(custom_nodes, tree_id), timeout, "convert")
+        # Every call of a synchronous client would block the event loop, so the conversion gets a worker thread.
+        # A thread cannot be interrupted: on timeout or cancellation it is told to stop before its next write,
+        # and the error is only raised once it has rolled back, so retrying never publishes the tree twice.
+        cancelled = threading.Event()
+        worker = asyncio.ensure_future(asyncio.to_thread(self.convert_custom_to_doctreen, custom_nodes, tree_id, cancelled))
+        try:
+            return await with_timeout(asyncio.shield(worker), timeout, "convert")
+        except BaseException:
+            cancelled.set()
+            await asyncio.gather(worker, return_exceptions=True)
+            if not worker.cancelled() and worker.exception() is None:
+                # The last write finished before the flag was seen; the tree is published.
+                return worker.result()
+            raise
+
+    async def _convert(self, custom_nodes, tree_id=None, cancelled=None):
+        # With tree_id the stored tree is updated in place instead of a new tree being created.
+        if tree_id is not None:
+            new_nodes, tree_doc = await self.aupdate_tree(custom_nodes, tree_id, cancelled=cancelled)
+            return new_nodes, tree_doc, f'https://front.interns.doctreen.io/edit/{tree_doc["_id"]}'
+        started = time.perf_counter()
+        new_nodes = []
+        tree_nodes = []
+        idMap = {}
+        root = ''
+        check = 0
+        total = len(custom_nodes)
+        in_memory = self.bulk_insert or self.atomic_publish
+        if in_memory:
+            with self.tracer.span("id_generation", tree=self.tree_name, kind="nodeId", documents=total):
+                node_uuids = await self.allocate(self.uuid_allocator, total)
+        else:
+            my_bar = self.ui.progress(0,"Generating UUIDs")
+        for index,node in enumerate(custom_nodes):
+            if in_memory:
+                node_uuid = node_uuids[index]
+            else:
+                node_uuid = await self.generate_unique_uuid(stream_lit_loop = my_bar,index = index+1,total = total)
+            idMap[node['id']] = node_uuid
+            
+            if node['nodeType'] == 'TYPE_ROOT' and check == 0:
+                root = node['id']
+                check = 1
+                
+            elif node['nodeType'] == 'TYPE_ROOT' and check == 1:
+                return 'INVALID ROOT', 0
         
-        print('=' * 20)
-        tree_result = self.trees_collection.insert_one(tree_doc)
-        print("Inserted tree document with _id:", tree_result.inserted_id)
+        if in_memory:
+            with self.tracer.span("id_generation", tree=self.tree_name, kind="_id", documents=total):
+                object_ids = await self.allocate(self.objectid_allocator, total)
+            new_nodes = [self.build_node_document(node, idMap, object_id) for node, object_id in zip(custom_nodes, object_ids)]
+            if self.subtree_library is not None:
+                await self.reuse_known_subtrees(new_nodes)
+        if self.atomic_publish:
+            tree_id = await self.generate_unique_tree_id()
+            tree_doc = await self.publish_atomically(new_nodes, idMap, root, tree_id, cancelled=cancelled)
+            logger.info("Published tree document with _id: %s", tree_id)
+        else:
+            try:
+                if self.bulk_insert:
+                    await self.insert_nodes_in_batches(new_nodes, idMap, cancelled=cancelled)
+                    tree_nodes = [doc["_id"] for doc in new_nodes]
+                else:
+                    my_bar.empty()
+                    my_bar = self.ui.progress(0,"Adding nodes to doctreen")
+                    for index,node in enumerate(custom_nodes):
+                        self.check_cancelled(cancelled)
+                        node_id = await self.generate_unique_objectid()
+                        tree_nodes.append(node_id)
+                        new_node = self.build_node_document(node, idMap, node_id)
+                        result = await self._stage("mongo_write", self.treenodes.insert_one(new_node))
+                        new_nodes.append(new_node)
+                        my_bar.progress((index+1)/total,text = f"Inserted node with _id:{result.inserted_id}")
+                    my_bar.empty()
+                self.check_cancelled(cancelled)
+            except ConversionCancelled:
+                # Cancelled before the tree document is created, so only the nodes are removed.
+                await self.arollback(new_nodes)
+                raise
+            tree_id = await self.generate_unique_tree_id()
+            tree_doc = self.build_tree_document(tree_id, tree_nodes, idMap.get(root, ''))
+            
+            print('=' * 20)
+            tree_result = await self._stage("mongo_write", self.trees.insert_one(tree_doc))
+            print("Inserted tree document with _id:", tree_result.inserted_id)
+        logger.info("ID allocator stats: %s", allocator_stats())
+        if self.subtree_library is not None and in_memory:
+            self.register_subtrees(new_nodes, tree_id)
+        self.tracer.record("convert", time.perf_counter() - started, tree=self.tree_name, nodes=total)
         tree_link = f'https://front.interns.doctreen.io/edit/{tree_id}'
         
         return new_nodes, tree_doc, tree_link
@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+SECTIONS = ("INDICATION", "TECHNICAL", "RESULT")
+BRANCH_PATTERN = re.compile(r'Return only this branch: "(.+?)"')
+
+
+class FakeChatModel:
+    # Deterministic stand-in for ChatGoogleGenerativeAI: the same messages always produce
+    # the same synthetic indented tree, so runs are replayable without network access.
+    def __init__(self, breadth: int = 3, depth: int = 4, latency: float = 0.0, chunk_size: int = 32, seed: int = 0):
+        self.model = "fake-chat-model"
+        self.breadth = breadth
+        self.depth = depth
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def section_for(self, messages: list) -> str:
+        system_prompt = messages[0].content if messages else ""
+        for section in SECTIONS:
+            if f"hierarchical {section} tree" in system_prompt:
+                return section
+        return SECTIONS[-1]
+
+    def render_tree(self, section: str, rng: random.Random, branch: str = None) -> str:
+        # Branch expansion requests get a single subtree rooted at the requested branch.
+        lines = [f"{section}: (TYPE_TITLE)" if branch is None else f"{branch}: (TYPE_TOPIC)"]
+
+        def add_level(level: int, prefix: str):
+            indent = "    " * level
+            for index in range(1, self.breadth + 1):
+                label = f"{prefix}{index}"
+                if level == self.depth:
+                    option_type = rng.choice(("TYPE_QCS", "TYPE_QCM"))
+                    lines.append(f"{indent}- Option {label} ({option_type})")
+                elif level == self.depth - 1:
+                    lines.append(f"{indent}Finding {label}? (TYPE_QUESTION)")
+                    add_level(level + 1, f"{label}.")
+                else:
+                    lines.append(f"{indent}{branch or section.title()} topic {label}: (TYPE_TOPIC)")
+                    add_level(level + 1, f"{label}.")
+
+        add_level(1, "")
+        return "\n".join(lines)
+
+    def _content(self, messages: list) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._respond(messages)
+
+    async def _acontent(self, messages: list) -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._respond(messages)
+
+    def _respond(self, messages: list) -> str:
+        with self._lock:
+            self.calls += 1
+        fingerprint = hashlib.sha256("\x00".join(m.content for m in messages).encode("utf-8")).digest()
+        rng = random.Random(int.from_bytes(fingerprint[:8], "big") ^ self.seed)
+        match = BRANCH_PATTERN.search(messages[-1].content) if messages else None
+        return self.render_tree(self.section_for(messages), rng, match.group(1) if match else None)
+
+    def invoke(self, messages: list):
+        from langchain.schema import AIMessage
+        return AIMessage(content=self._content(messages))
+
+    def stream(self, messages: list):
+        from langchain.schema import AIMessage
+        content = self._content(messages)
+        for start in range(0, len(content), self.chunk_size):
+            yield AIMessage(content=content[start:start + self.chunk_size])
+
+    async def ainvoke(self, messages: list):
+        from langchain.schema import AIMessage
+        return AIMessage(content=await self._acontent(messages))
+
+    async def astream(self, messages: list):
+        from langchain.schema import AIMessage
+        content = await self._acontent(messages)
+        for start in range(0, len(content), self.chunk_size):
+            yield AIMessage(content=content[start:start + self.chunk_size])
+
+
+class RecordedChatModel(FakeChatModel):
+    # Replays recorded trees: every call for a section returns that section's recorded text.
+    def __init__(self, recorded: dict, latency: float = 0.0, chunk_size: int = 32):
+        super().__init__(latency=latency, chunk_size=chunk_size)
+        self.model = "recorded-chat-model"
+        self.recorded = recorded
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs):
+        # Accepts {"INDICATION": text, ...} or an iteration checkpoint file, whose last round per section is used.
+        with open(path) as f:
+            data = json.load(f)
+        recorded = {}
+        for section, value in data.items():
+            section = "TECHNICAL" if section == "TECHNIQUE" else section
+            recorded[section] = value["iterations"][-1] if isinstance(value, dict) else value
+        return cls(recorded, **kwargs)
+
+    def _respond(self, messages: list) -> str:
+        with self._lock:
+            self.calls += 1
+        return self.recorded[self.section_for(messages)]
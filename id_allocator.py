@@ -0,0 +1,116 @@
+import threading
+import uuid
+from mongo_connection import AwaitableCollection
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def uuid4_string() -> str:
+    return str(uuid.uuid4())
+
+
+class IdAllocator:
+    # Mints candidate IDs in batches and checks each batch with a single $in query,
+    # instead of one find_one per ID.
+    def __init__(self, collection, field: str, factory, batch_size: int = 256):
+        self.collection = collection
+        self.field = field
+        self.factory = factory
+        self.batch_size = batch_size
+        self.pool = []
+        self.minted = 0
+        self.queries = 0
+        self.collisions = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def _candidates(self, count: int) -> list:
+        self.queries += 1
+        return list(dict.fromkeys(self.factory() for _ in range(max(self.batch_size, count - len(self.pool)))))
+
+    def _accept(self, candidates, taken):
+        if taken:
+            self.collisions += len(taken)
+            self.retries += 1
+        self.pool.extend(candidate for candidate in candidates if candidate not in taken)
+
+    def _take(self, count: int) -> list:
+        ids, self.pool = self.pool[:count], self.pool[count:]
+        self.minted += len(ids)
+        return ids
+
+    def _refill(self, count: int):
+        while len(self.pool) < count:
+            candidates = self._candidates(count)
+            self._accept(candidates, {doc[self.field] for doc in self.collection.find({self.field: {"$in": candidates}}, {self.field: 1})})
+
+    def allocate(self):
+        return self.allocate_many(1)[0]
+
+    def allocate_many(self, count: int) -> list:
+        with self._lock:
+            self._refill(count)
+            return self._take(count)
+
+    async def aallocate_many(self, count: int) -> list:
+        # The lock is not held while the query is awaited; concurrent refills only leave extra IDs in the pool.
+        collection = AwaitableCollection(self.collection)
+        while True:
+            with self._lock:
+                if len(self.pool) >= count:
+                    return self._take(count)
+                candidates = self._candidates(count)
+            taken = {doc[self.field] for doc in await collection.find({self.field: {"$in": candidates}}, {self.field: 1})}
+            with self._lock:
+                self._accept(candidates, taken)
+
+    def _conflict(self):
+        with self._lock:
+            self.collisions += 1
+            self.retries += 1
+
+    def replace_conflicting(self):
+        # Called when a write still hit a duplicate key (e.g. a concurrent writer took the ID).
+        self._conflict()
+        return self.allocate()
+
+    async def areplace_conflicting(self):
+        self._conflict()
+        return (await self.aallocate_many(1))[0]
+
+    def stats(self) -> dict:
+        return {
+            "collection": self.collection.full_name,
+            "field": self.field,
+            "minted": self.minted,
+            "queries": self.queries,
+            "collisions": self.collisions,
+            "retries": self.retries,
+            "lookups_saved": max(self.minted - self.queries, 0),
+        }
+
+
+def get_allocator(collection, field: str, factory, batch_size: int = 256) -> IdAllocator:
+    # Pooled IDs were only checked against one deployment, so allocators are shared per client, never across
+    # clients: two clusters can have the same database and collection names, and an async client is bound to
+    # its event loop. The allocator keeps its client alive, so the id() in the key cannot be reused.
+    client = collection.database.client
+    key = (id(client), collection.full_name, field)
+    with _registry_lock:
+        allocator = _registry.get(key)
+        if allocator is None:
+            allocator = _registry[key] = IdAllocator(collection, field, factory, batch_size)
+        return allocator
+
+
+def release_allocators(client):
+    # Drops the allocators (and unused pooled IDs) of a client that is being closed.
+    with _registry_lock:
+        for key in [key for key in _registry if key[0] == id(client)]:
+            del _registry[key]
+
+
+def allocator_stats() -> list:
+    with _registry_lock:
+        return [allocator.stats() for allocator in _registry.values()]
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_cache_key(model_name: str, temperature, messages: list) -> str:
+    payload = {
+        "model": model_name,
+        "temperature": temperature,
+        "messages": [[getattr(m, "type", type(m).__name__), m.content] for m in messages],
+    }
+    encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class LLMResponseCache:
+    # Base class: subclasses implement _load/_store/_evict, counters are shared.
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._load(key, time.time())
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._store(key, value, time.time())
+            self.evictions += self._evict(time.time())
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def _load(self, key, now):
+        raise NotImplementedError
+
+    def _store(self, key, value, now):
+        raise NotImplementedError
+
+    def _evict(self, now) -> int:
+        raise NotImplementedError
+
+
+class MemoryLLMCache(LLMResponseCache):
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = None):
+        super().__init__(max_entries, ttl_seconds)
+        self._entries = OrderedDict()
+
+    def _load(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, created_at = entry
+        if self._expired(created_at, now):
+            del self._entries[key]
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _store(self, key, value, now):
+        self._entries[key] = (value, now)
+        self._entries.move_to_end(key)
+
+    def _evict(self, now) -> int:
+        evicted = 0
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+
+class SQLiteLLMCache(LLMResponseCache):
+    def __init__(self, path: str = "llm_cache.sqlite", max_entries: int = 5000, ttl_seconds: float = 7 * 24 * 3600):
+        super().__init__(max_entries, ttl_seconds)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self.conn.commit()
+
+    def _load(self, key, now):
+        row = self.conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, created_at = row
+        if self._expired(created_at, now):
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.conn.commit()
+            self.evictions += 1
+            return None
+        self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        self.conn.commit()
+        return value
+
+    def _store(self, key, value, now):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+            (key, value, now, now),
+        )
+        self.conn.commit()
+
+    def _evict(self, now) -> int:
+        evicted = 0
+        if self.ttl_seconds is not None:
+            evicted += self.conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)
+            ).rowcount
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if count > self.max_entries:
+            evicted += self.conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,),
+            ).rowcount
+        self.conn.commit()
+        return evicted
+
+    def close(self):
+        self.conn.close()
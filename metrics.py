@@ -0,0 +1,117 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+SUMMED_ATTRIBUTES = ("input_tokens", "output_tokens", "nodes", "documents")
+# Spans flagged with tokens_estimated carry length-based guesses, which are kept apart from reported counts.
+ESTIMATED_ATTRIBUTES = ("input_tokens", "output_tokens")
+
+logger = logging.getLogger(__name__)
+
+_tracers = {}
+_tracers_lock = threading.Lock()
+_prometheus = {}
+_prometheus_lock = threading.Lock()
+
+
+def prometheus_metrics(port: int):
+    # Starts one local /metrics endpoint per port; returns None when prometheus_client is not installed.
+    with _prometheus_lock:
+        if port in _prometheus:
+            return _prometheus[port]
+        try:
+            import prometheus_client
+        except ImportError:
+            logger.warning("prometheus_client is not installed, the metrics endpoint is disabled")
+            _prometheus[port] = None
+            return None
+        registry = prometheus_client.CollectorRegistry()
+        metrics = {
+            "seconds": prometheus_client.Histogram("doctreen_span_seconds", "Span duration", ["span"], registry=registry,
+                                                   buckets=(0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)),
+            "errors": prometheus_client.Counter("doctreen_span_errors", "Spans that raised", ["span"], registry=registry),
+        }
+        for attribute in SUMMED_ATTRIBUTES:
+            metrics[attribute] = prometheus_client.Counter(f"doctreen_{attribute}", f"Total {attribute}", ["span"],
+                                                           registry=registry)
+        for attribute in ESTIMATED_ATTRIBUTES:
+            metrics[f"{attribute}_estimated"] = prometheus_client.Counter(
+                f"doctreen_{attribute}_estimated", f"Total {attribute} estimated from text length, not reported by the model",
+                ["span"], registry=registry)
+        prometheus_client.start_http_server(port, registry=registry)
+        _prometheus[port] = metrics
+        return metrics
+
+
+def summed_key(attribute: str, attributes: dict) -> str:
+    if attributes.get("tokens_estimated") and attribute in ESTIMATED_ATTRIBUTES:
+        return f"{attribute}_estimated"
+    return attribute
+
+
+class Tracer:
+    # Records named spans with their duration and attributes. Every finished span is aggregated in memory,
+    # appended to a JSON lines file when a path is set and exported to Prometheus when a port is set.
+    def __init__(self, path: str = None, prometheus_port: int = None):
+        self.path = path
+        self.totals = {}
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8") if path else None
+        self.prometheus = prometheus_metrics(prometheus_port) if prometheus_port is not None else None
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        # The attributes dict is yielded so the block can attach values it only knows at the end.
+        started_at = time.time()
+        started = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(name, time.perf_counter() - started, started_at=started_at, **attributes)
+
+    def record(self, name: str, seconds: float, **attributes):
+        entry = {"span": name, "seconds": round(seconds, 6)}
+        entry.update(attributes)
+        with self._lock:
+            total = self.totals.setdefault(name, {"count": 0, "seconds": 0.0, "errors": 0})
+            total["count"] += 1
+            total["seconds"] += seconds
+            if "error" in attributes:
+                total["errors"] += 1
+            for attribute in SUMMED_ATTRIBUTES:
+                if isinstance(attributes.get(attribute), int):
+                    key = summed_key(attribute, attributes)
+                    total[key] = total.get(key, 0) + attributes[attribute]
+            if self._file is not None:
+                self._file.write(json.dumps(entry, default=str) + "\n")
+                self._file.flush()
+        if self.prometheus is not None:
+            self.prometheus["seconds"].labels(name).observe(seconds)
+            if "error" in attributes:
+                self.prometheus["errors"].labels(name).inc()
+            for attribute in SUMMED_ATTRIBUTES:
+                if isinstance(attributes.get(attribute), int):
+                    self.prometheus[summed_key(attribute, attributes)].labels(name).inc(attributes[attribute])
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {name: dict(total, seconds=round(total["seconds"], 3)) for name, total in self.totals.items()}
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def get_tracer(name: str = "default", **kwargs) -> Tracer:
+    with _tracers_lock:
+        tracer = _tracers.get(name)
+        if tracer is None:
+            tracer = _tracers[name] = Tracer(**kwargs)
+        return tracer
@@ -0,0 +1,105 @@
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_POOL_SIZE = 50
+DEFAULT_MIN_POOL_SIZE = 0
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(uri, max_pool_size=DEFAULT_MAX_POOL_SIZE, min_pool_size=DEFAULT_MIN_POOL_SIZE, check_health=False):
+    # One MongoClient per URI for the whole process; pymongo clients are thread-safe and pool connections.
+    with _clients_lock:
+        client = _clients.get(uri)
+        if client is not None and check_health and not ping(client):
+            logger.warning("MongoDB health check failed, reconnecting")
+            release(client)
+            client = None
+        if client is None:
+            import pymongo
+            client = pymongo.MongoClient(uri, maxPoolSize=max_pool_size, minPoolSize=min_pool_size)
+            _clients[uri] = client
+        return client
+
+
+def get_async_client(uri, max_pool_size=DEFAULT_MAX_POOL_SIZE, min_pool_size=DEFAULT_MIN_POOL_SIZE):
+    # asyncio client for aconvert: PyMongo's own async API, or Motor on older PyMongo releases.
+    # Async clients belong to the event loop they are first used on, so unlike get_client they are not shared.
+    # Close them with release() so their ID allocators are dropped as well.
+    try:
+        from pymongo import AsyncMongoClient
+    except ImportError:
+        from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+    return AsyncMongoClient(uri, maxPoolSize=max_pool_size, minPoolSize=min_pool_size)
+
+
+def is_async_driver(obj) -> bool:
+    # Clients, databases and collections of Motor and PyMongo's async API return awaitables from their operations.
+    return type(obj).__module__.startswith(("motor.", "pymongo.asynchronous."))
+
+
+class AwaitableCollection:
+    # Awaitable view of a collection, so one async code path serves both drivers. Operations of a synchronous
+    # collection run inline and complete without suspending; those of an async collection are awaited.
+    def __init__(self, collection):
+        self.collection = collection
+        self.is_async = is_async_driver(collection)
+        self.full_name = collection.full_name
+
+    async def find(self, *args, **kwargs) -> list:
+        cursor = self.collection.find(*args, **kwargs)
+        return await cursor.to_list(None) if self.is_async else list(cursor)
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+
+        async def call(*args, **kwargs):
+            result = method(*args, **kwargs)
+            return await result if self.is_async else result
+
+        return call
+
+
+def ping(client) -> bool:
+    from pymongo.errors import PyMongoError
+    try:
+        client.admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+def health_check() -> dict:
+    with _clients_lock:
+        clients = list(_clients.items())
+    return {uri.split("@")[-1]: ping(client) for uri, client in clients}
+
+
+def close_client(uri):
+    with _clients_lock:
+        client = _clients.pop(uri, None)
+    if client is not None:
+        release(client)
+
+
+def close_all():
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        release(client)
+
+
+def release(client):
+    # Closes a client and forgets the ID allocators bound to it. For PyMongo's async client the returned
+    # close() coroutine must be awaited.
+    from id_allocator import release_allocators
+    release_allocators(client)
+    return client.close()
+
+
+atexit.register(close_all)
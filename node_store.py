@@ -0,0 +1,267 @@
+import hashlib
+from array import array
+
+NO_PARENT = -1
+MISSING_PARENT = -2
+
+
+def merkle_digest(text: str, node_type: str, parent_text, child_digests) -> bytes:
+    # Fixed-size digest of a node's own fields plus its children's digests.
+    fields = "\x00".join((text, node_type, "\x01" if parent_text is None else parent_text))
+    return hashlib.blake2b(fields.encode("utf-8") + b"\x00" + b"".join(child_digests), digest_size=16).digest()
+
+
+class NodeStore:
+    # Column-oriented node table: interned strings, integer IDs and CSR child arrays.
+    __slots__ = ("strings", "string_index", "ids", "texts", "types", "parents", "parent_texts",
+                 "leaf", "child_offsets", "child_rows")
+
+    def __init__(self):
+        self.strings = []
+        self.string_index = {}
+        self.ids = array("q")
+        self.texts = array("i")
+        self.types = array("i")
+        self.parents = array("i")
+        self.parent_texts = array("i")
+        self.leaf = bytearray()
+        self.child_offsets = array("i", [0])
+        self.child_rows = array("i")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern(self, value) -> int:
+        if value is None:
+            return -1
+        index = self.string_index.get(value)
+        if index is None:
+            index = self.string_index[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+    def string(self, index):
+        return None if index < 0 else self.strings[index]
+
+    def children(self, row: int):
+        return self.child_rows[self.child_offsets[row]:self.child_offsets[row + 1]]
+
+    def _append_row(self, node_id: int, text: str, node_type: str, parent_row: int, parent_text, is_leaf: bool):
+        self.ids.append(node_id)
+        self.texts.append(self.intern(text))
+        self.types.append(self.intern(node_type))
+        self.parents.append(parent_row)
+        self.parent_texts.append(self.intern(parent_text))
+        self.leaf.append(1 if is_leaf else 0)
+
+    def append_parsed(self, node_id: int, text: str, node_type: str, parent_row: int) -> int:
+        # Row of a freshly parsed line: it is a leaf until a child is appended, and its children
+        # are only linked by link_children once the whole section has been read.
+        row = len(self.ids)
+        self._append_row(node_id, text, node_type, parent_row,
+                         None if parent_row < 0 else self.strings[self.texts[parent_row]], True)
+        if parent_row >= 0:
+            self.leaf[parent_row] = 0
+        return row
+
+    def link_children(self):
+        # Builds the CSR child arrays from the parent column; children keep their row (document) order.
+        size = len(self.ids)
+        offsets = array("i", [0]) * (size + 1)
+        for parent_row in self.parents:
+            if parent_row >= 0:
+                offsets[parent_row + 1] += 1
+        for row in range(size):
+            offsets[row + 1] += offsets[row]
+        child_rows = array("i", [0]) * offsets[size]
+        next_slot = offsets[:-1]
+        for row, parent_row in enumerate(self.parents):
+            if parent_row >= 0:
+                child_rows[next_slot[parent_row]] = row
+                next_slot[parent_row] += 1
+        self.child_offsets = offsets
+        self.child_rows = child_rows
+
+    @classmethod
+    def from_nodes(cls, nodes: list):
+        store = cls()
+        row_of = {node["id"]: row for row, node in enumerate(nodes)}
+        for node in nodes:
+            parent = node["parent"]
+            parent_row = NO_PARENT if parent is None else row_of.get(parent, MISSING_PARENT)
+            store._append_row(int(node["id"]), node["text"], node["nodeType"], parent_row,
+                              node.get("parentText"), node["isLeaf"])
+            store.child_rows.extend(row_of[child_id] for child_id in node["childs"])
+            store.child_offsets.append(len(store.child_rows))
+        return store
+
+    def compute_digests(self) -> list:
+        memo = [None] * len(self)
+        encoded = {}
+        strings, texts, types, parent_texts = self.strings, self.texts, self.types, self.parent_texts
+        offsets, child_rows = self.child_offsets, self.child_rows
+
+        def digest(row, child_digests):
+            key = (texts[row], types[row], parent_texts[row])
+            fields = encoded.get(key)
+            if fields is None:
+                parent_text = self.string(key[2])
+                fields = encoded[key] = "\x00".join(
+                    (strings[key[0]], strings[key[1]], "\x01" if parent_text is None else parent_text)
+                ).encode("utf-8") + b"\x00"
+            return hashlib.blake2b(fields + b"".join(child_digests), digest_size=16).digest()
+
+        for start in range(len(self) - 1, -1, -1):
+            if memo[start] is not None:
+                continue
+            child_digests = [memo[child] for child in child_rows[offsets[start]:offsets[start + 1]]]
+            if None not in child_digests:
+                memo[start] = digest(start, child_digests)
+                continue
+            stack = [(start, False)]
+            while stack:
+                row, children_done = stack.pop()
+                if memo[row] is not None:
+                    continue
+                children = child_rows[offsets[row]:offsets[row + 1]]
+                if children_done:
+                    memo[row] = digest(row, [memo[child] for child in children])
+                else:
+                    stack.append((row, True))
+                    stack.extend((child, False) for child in reversed(children) if memo[child] is None)
+        return memo
+
+    def section_digests(self, root_text: str) -> tuple:
+        # Deduplicates this section and returns what the combined tree would compute for it: the
+        # surviving rows, their deduplicated child lists and their digests once the first root hangs
+        # under root_text. Subtrees whose child lists did not shrink keep their first-pass digest.
+        first_digests = self.compute_digests()
+        size = len(self)
+        offsets, child_rows = self.child_offsets, self.child_rows
+        canonical = {}
+        alias = list(range(size))
+        live_rows = []
+        for row in range(size):
+            canonical_row = canonical.setdefault(first_digests[row], row)
+            if canonical_row == row:
+                live_rows.append(row)
+            else:
+                alias[row] = canonical_row
+        children = [None] * size
+        changed = bytearray(size)
+        for row in live_rows:
+            raw = child_rows[offsets[row]:offsets[row + 1]].tolist()
+            kids = [alias[child] for child in raw]
+            # Raw children are distinct rows, so duplicates can only appear when one was aliased.
+            if kids != raw and len(kids) > 1:
+                kids = list(dict.fromkeys(kids))
+                changed[row] = len(kids) != len(raw)
+            children[row] = kids
+        section_root = next((row for row in live_rows if self.parents[row] == NO_PARENT), None)
+        strings, texts, types, parent_texts = self.strings, self.texts, self.types, self.parent_texts
+        if section_root is not None and not changed.count(1) and section_root not in child_rows \
+                and alias.count(section_root) == 1:
+            # Usual case: no child list shrank and nothing points at the root, so only the root's digest changes.
+            digests = list(first_digests)
+            digests[section_root] = merkle_digest(strings[texts[section_root]], strings[types[section_root]], root_text,
+                                                  [digests[kid] for kid in children[section_root]])
+            return live_rows, children, digests, section_root
+        if section_root is not None:
+            changed[section_root] = 1
+        digests = [None] * size
+
+        def digest(row):
+            kids = children[row]
+            if not changed[row]:
+                for kid in kids:
+                    if changed[kid]:
+                        changed[row] = 1
+                        break
+                else:
+                    return first_digests[row]
+            parent_text = root_text if row == section_root else self.string(parent_texts[row])
+            return merkle_digest(strings[texts[row]], strings[types[row]], parent_text, [digests[kid] for kid in kids])
+
+        for start in reversed(live_rows):
+            if digests[start] is not None:
+                continue
+            if None not in [digests[kid] for kid in children[start]]:
+                digests[start] = digest(start)
+                continue
+            stack = [(start, False)]
+            while stack:
+                row, children_done = stack.pop()
+                if digests[row] is not None:
+                    continue
+                if children_done:
+                    digests[row] = digest(row)
+                else:
+                    stack.append((row, True))
+                    stack.extend((kid, False) for kid in reversed(children[row]) if digests[kid] is None)
+        return live_rows, children, digests, section_root
+
+    @classmethod
+    def fuse(cls, root_id: int, root_type: str, root_text: str, stores: list, sections: list = None) -> list:
+        # One pass with the same output as deduplicating every section, then combine_trees and
+        # transform_nodes on the dicts, without building a combined tree. Rows are addressed by a global
+        # number (section offset + row, the new root is 0) so canonical choices compare as integers.
+        if sections is None:
+            sections = [store.section_digests(root_text) for store in stores]
+        sections = [(store, *section) for store, section in zip(stores, sections)]
+        offsets = []
+        total = 1
+        for store in stores:
+            offsets.append(total)
+            total += len(store)
+        ids = [str(root_id)] + [None] * (total - 1)
+        texts = [root_text] + [None] * (total - 1)
+        roots = [(offset, section) for offset, section in zip(offsets, sections) if section[4] is not None]
+        root_children = [offset + section[4] for offset, section in roots]
+        root_digest = merkle_digest(root_text, root_type, None, [section[3][section[4]] for _, section in roots])
+        canonical = {root_digest: 0}
+        alias = list(range(total))
+        for offset, (store, live_rows, children, digests, section_root) in zip(offsets, sections):
+            strings, store_texts, store_ids = store.strings, store.texts, store.ids
+            for row in live_rows:
+                number = offset + row
+                alias[number] = canonical.setdefault(digests[row], number)
+                ids[number] = str(store_ids[row])
+                texts[number] = strings[store_texts[row]]
+
+        def references(numbers):
+            mapped = [alias[number] for number in numbers]
+            if mapped != numbers and len(mapped) > 1:
+                mapped = dict.fromkeys(mapped)
+            return [{"id": ids[number], "text": texts[number]} for number in mapped]
+
+        transformed = [{
+            "id": ids[0],
+            "nodeType": root_type,
+            "text": root_text,
+            "isLeaf": False,
+            "parent": None,
+            "childs": references(root_children)
+        }]
+        for offset, (store, live_rows, children, digests, section_root) in zip(offsets, sections):
+            strings, types, parents, leaf = store.strings, store.types, store.parents, store.leaf
+            for row in live_rows:
+                number = offset + row
+                if alias[number] != number:
+                    continue
+                if row == section_root:
+                    parent = {"id": ids[0], "text": root_text}
+                else:
+                    parent_row = parents[row]
+                    parent = None
+                    # The parent must have survived both the section and the combined deduplication.
+                    if parent_row >= 0 and ids[offset + parent_row] is not None and alias[offset + parent_row] == offset + parent_row:
+                        parent = {"id": ids[offset + parent_row], "text": texts[offset + parent_row]}
+                transformed.append({
+                    "id": ids[number],
+                    "nodeType": strings[types[row]],
+                    "text": texts[number],
+                    "isLeaf": bool(leaf[row]),
+                    "parent": parent,
+                    "childs": references([offset + kid for kid in children[row]])
+                })
+        return transformed
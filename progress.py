@@ -0,0 +1,40 @@
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+
+class NullProgress:
+    # Stands in for the Streamlit progress bar and text elements when running headless.
+    def progress(self, value, text=None):
+        pass
+
+    def text(self, value):
+        pass
+
+    def empty(self):
+        return self
+
+
+class NullUI:
+    # Headless counterpart of the streamlit calls the converter makes; messages are logged.
+    def progress(self, value, text=None):
+        return NullProgress()
+
+    def info(self, message):
+        logger.info("%s", message)
+
+
+class StreamlitUI:
+    def progress(self, value, text=None):
+        import streamlit as st
+        return st.progress(value, text=text)
+
+    def info(self, message):
+        import streamlit as st
+        st.info(message)
+
+
+def default_ui():
+    # Inside a Streamlit app the module is already loaded; anywhere else streamlit is never imported.
+    return StreamlitUI() if "streamlit" in sys.modules else NullUI()
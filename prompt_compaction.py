@@ -0,0 +1,192 @@
+import logging
+import re
+from node_store import merkle_digest
+from rate_limiter import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+ANSWER_TYPES = {"TYPE_QCS", "TYPE_QCM"}
+DIFF_HEADER = re.compile(r"^@([\w.]+)\s*:?\s*$")
+
+
+class OutlineNode:
+    __slots__ = ("line", "indent", "text", "node_type", "answer", "parent", "children", "end", "signature")
+
+    def __init__(self, line, indent, text, node_type, answer, parent):
+        self.line = line
+        self.indent = indent
+        self.text = text
+        self.node_type = node_type
+        self.answer = answer
+        self.parent = parent
+        self.children = []
+        self.end = line
+        self.signature = None
+
+
+class PromptCompactor:
+    # Replaces the full previous tree in refinement prompts with a condensed outline and asks the
+    # model to return only the sub-nodes it adds under a few keyed branches; apply_diff grafts them
+    # back into the full text.
+    def __init__(self, generator, context_depth: int = 3, max_targets: int = 40):
+        self.generator = generator
+        self.context_depth = context_depth
+        self.max_targets = max_targets
+
+    def parse(self, text: str) -> tuple:
+        lines = text.splitlines()
+        nodes = []
+        stack = []
+        for index, line in enumerate(lines):
+            token = self.generator.tokenize_line(line)
+            if token is None:
+                continue
+            indent, new_text, node_type, is_list_item = token
+            while stack and indent <= stack[-1].indent:
+                stack.pop()
+            node = OutlineNode(index, indent, new_text, node_type or "",
+                               is_list_item or node_type in ANSWER_TYPES, stack[-1] if stack else None)
+            if node.parent is not None:
+                node.parent.children.append(node)
+            for ancestor in stack:
+                ancestor.end = index
+            nodes.append(node)
+            stack.append(node)
+        for node in reversed(nodes):
+            # Same Merkle digest as NodeStore signatures, with generate_alias keys in place of raw text.
+            node.signature = merkle_digest(self.generator.generate_alias(node.text, node.node_type), node.node_type,
+                                           node.parent.text if node.parent is not None else None,
+                                           [child.signature for child in node.children])
+        return lines, nodes
+
+    def assign_keys(self, nodes: list) -> dict:
+        # Expansion targets are the root, its top-level branches and every leaf that is not an answer.
+        # Identical subtrees share one key so an expansion is applied to all of their copies.
+        targets = [node for node in nodes
+                   if node.parent is None or node.parent.parent is None or (not node.children and not node.answer)]
+        keys = {}
+        key_of_signature = {}
+        for node in targets[:self.max_targets]:
+            key = key_of_signature.get(node.signature)
+            if key is None:
+                base = self.generator.generate_alias(node.text, node.node_type) or "node"
+                key = base
+                if key in keys and node.parent is not None:
+                    key = f"{self.generator.generate_alias(node.parent.text, node.parent.node_type)}.{base}"
+                suffix = 2
+                while key in keys:
+                    key = f"{base}_{suffix}"
+                    suffix += 1
+                key_of_signature[node.signature] = key
+                keys[key] = []
+            keys[key].append(node)
+        return keys
+
+    def render_outline(self, nodes: list, keys: dict = None, max_depth: int = None) -> str:
+        # Answer lists are folded onto their question's line and repeated subtrees are only spelled out once.
+        key_of_line = {node.line: key for key, group in (keys or {}).items() for node in group}
+        seen = {}
+        out = []
+
+        def render(node, depth):
+            label = f"{node.text} ({node.node_type})" if node.node_type else node.text
+            if node.line in key_of_line:
+                label += f" @{key_of_line[node.line]}"
+            indent = "  " * depth
+            if node.children and node.signature in seen:
+                out.append(f"{indent}{label} = same as {seen[node.signature]}")
+                return
+            if node.children:
+                seen[node.signature] = node.text
+            if node.children and all(child.answer and not child.children for child in node.children):
+                types = {child.node_type for child in node.children}
+                answers = " | ".join(child.text for child in node.children)
+                suffix = f" ({types.pop()})" if len(types) == 1 else ""
+                out.append(f"{indent}{label}: {answers}{suffix}")
+                return
+            out.append(indent + label)
+            if max_depth is not None and depth >= max_depth:
+                if node.children:
+                    out.append(f"{indent}  ... {len(node.children)} more")
+                return
+            for child in node.children:
+                render(child, depth + 1)
+
+        for node in nodes:
+            if node.parent is None:
+                render(node, 0)
+        return "\n".join(out)
+
+    def context_outline(self, text: str) -> str:
+        # Depth-limited outline used when another section's tree is only needed as context.
+        _, nodes = self.parse(text)
+        return self.render_outline(nodes, max_depth=self.context_depth)
+
+    def refinement_block(self, section: str, text: str) -> str:
+        _, nodes = self.parse(text)
+        keys = self.assign_keys(nodes)
+        outline = self.render_outline(nodes, keys)
+        return f"""(condensed outline of the current {section} tree, two spaces per level, answers folded after ":"; keyed branches are marked with @key)
+{outline}
+
+Branches to expand: {", ".join("@" + key for key in keys)}
+"""
+
+    def diff_instructions(self, section: str) -> str:
+        return f"""
+**compact response format (overrides the return format above):**
+- Do not repeat the existing {section} tree. Return only the nodes you add.
+- Start each group of additions with a line containing only the branch key, e.g. "@patient_information", at zero indentation.
+- Below it, list the new sub-nodes indented at 4 spaces per level, exactly as they would appear under that branch, each with its nodetype in parentheses.
+- Only use keys from the "Branches to expand" list; add new top-level categories under the key of the "{section}" node.
+"""
+
+    def apply_diff(self, text: str, response: str) -> str:
+        response_lines = response.splitlines()
+        if not any(DIFF_HEADER.match(line.strip()) for line in response_lines):
+            # The model answered with a full tree instead of additions; use it as is.
+            return response if response.strip() else text
+        lines, nodes = self.parse(text)
+        keys = self.assign_keys(nodes)
+        blocks = []
+        current = None
+        for line in response_lines:
+            match = DIFF_HEADER.match(line.strip())
+            if match:
+                current = (match.group(1), [])
+                blocks.append(current)
+            elif current is not None and line.strip():
+                current[1].append(line.replace("\t", "    ").replace("```", ""))
+        insertions = {}
+        for key, block in blocks:
+            if not block:
+                continue
+            if key not in keys:
+                logger.warning("Ignoring additions for unknown branch @%s", key)
+                continue
+            base_indent = min(len(line) - len(line.lstrip(" ")) for line in block)
+            for node in keys[key]:
+                child_indent = node.children[0].indent if node.children else node.indent + 4
+                insertions.setdefault(node.end, []).append((node.indent, [
+                    " " * (child_indent + len(line) - len(line.lstrip(" ")) - base_indent) + line.strip()
+                    for line in block
+                ]))
+        merged = []
+        for index, line in enumerate(lines):
+            merged.append(line)
+            # When several branches end on the same line, the deepest one's additions must come first.
+            for _, added in sorted(insertions.get(index, ()), key=lambda item: -item[0]):
+                merged.extend(added)
+        return "\n".join(merged)
+
+
+def prompt_tokens(messages: list) -> int:
+    return estimate_tokens("".join(m.content for m in messages))
+
+
+def add_usage(usage: dict, message):
+    # Adds the token counts the model reported for a response or stream chunk; nothing is added when it reports none.
+    metadata = getattr(message, "usage_metadata", None)
+    if metadata:
+        for field in ("input_tokens", "output_tokens"):
+            usage[field] = usage.get(field, 0) + (metadata.get(field) or 0)
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import random
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REQUESTS_PER_MINUTE = 60
+DEFAULT_TOKENS_PER_MINUTE = 1_000_000
+RETRYABLE_STATUS_CODES = {429, 500, 503}
+RETRYABLE_ERROR_NAMES = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded",
+                         "InternalServerError"}
+RETRY_AFTER_PATTERN = re.compile(r"retry(?:[_ ]delay|[- ]after| in)[^0-9]{0,20}(\d+(?:\.\d+)?)", re.IGNORECASE)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: float = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _take(self, amount: float) -> float:
+        # Takes `amount` and returns 0, or returns how long to wait before trying again.
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.level >= amount:
+                self.level -= amount
+                return 0.0
+            return (amount - self.level) / self.rate
+
+    def acquire(self, amount: float = 1.0) -> float:
+        # Blocks until `amount` is available and returns the time spent waiting.
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            delay = self._take(amount)
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    async def aacquire(self, amount: float = 1.0) -> float:
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            delay = self._take(amount)
+            if not delay:
+                return waited
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def set_rate(self, per_minute: float):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = per_minute / 60.0
+            self.capacity = per_minute
+            self.level = min(self.level, self.capacity)
+
+    def debit(self, amount: float):
+        # Charges usage that was only known after the call; the level may go negative.
+        with self._lock:
+            self._refill(time.monotonic())
+            self.level -= amount
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def is_retryable(error: Exception) -> bool:
+    # Decided by exception type or HTTP status only, never by the message text. Client wrappers
+    # (e.g. langchain's ChatGoogleGenerativeAIError) are raised from the API error, so the cause chain is checked too.
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if type(error).__name__ in RETRYABLE_ERROR_NAMES:
+            return True
+        for attribute in ("code", "status_code"):
+            if getattr(error, attribute, None) in RETRYABLE_STATUS_CODES:
+                return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def retry_after_hint(error: Exception):
+    value = getattr(error, "retry_after", None)
+    if value is not None:
+        return float(value)
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    match = RETRY_AFTER_PATTERN.search(str(error))
+    return float(match.group(1)) if match else None
+
+
+class RateLimiter:
+    # Shared request and token buckets plus retry with exponential backoff and jitter.
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+                 max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.calls = 0
+        self.retries = 0
+        self.throttled_seconds = 0.0
+        self.backoff_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, requests_per_minute=None, tokens_per_minute=None):
+        if requests_per_minute is not None:
+            self.requests.set_rate(requests_per_minute)
+        if tokens_per_minute is not None:
+            self.tokens.set_rate(tokens_per_minute)
+
+    def backoff_delay(self, attempt: int, error: Exception) -> float:
+        hint = retry_after_hint(error)
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        delay = random.uniform(delay / 2, delay)
+        return max(delay, hint) if hint is not None else delay
+
+    def _started(self, waited: float):
+        with self._lock:
+            self.calls += 1
+            self.throttled_seconds += waited
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        # Returns how long to back off before the next attempt; re-raises errors that are not worth retrying.
+        if attempt >= self.max_retries or not is_retryable(error):
+            raise error
+        delay = self.backoff_delay(attempt, error)
+        with self._lock:
+            self.retries += 1
+            self.backoff_seconds += delay
+        logger.warning("Model call failed (%s), retry %d/%d in %.1fs", type(error).__name__, attempt + 1, self.max_retries, delay)
+        return delay
+
+    def call(self, fn, input_tokens: int = 1):
+        # fn returns the response text; its size is charged to the token bucket afterwards.
+        attempt = 0
+        while True:
+            self._started(self.requests.acquire(1) + self.tokens.acquire(input_tokens))
+            try:
+                result = fn()
+            except Exception as e:
+                time.sleep(self._retry_delay(attempt, e))
+                attempt += 1
+                continue
+            self.tokens.debit(estimate_tokens(result))
+            return result
+
+    async def acall(self, fn, input_tokens: int = 1):
+        # Async counterpart of call: fn is a coroutine function and waiting never blocks the event loop.
+        attempt = 0
+        while True:
+            self._started(await self.requests.aacquire(1) + await self.tokens.aacquire(input_tokens))
+            try:
+                result = await fn()
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(attempt, e))
+                attempt += 1
+                continue
+            self.tokens.debit(estimate_tokens(result))
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+                "backoff_seconds": round(self.backoff_seconds, 3),
+            }
+
+
+def get_rate_limiter(name: str = "gemini", requests_per_minute=None, tokens_per_minute=None, **kwargs) -> RateLimiter:
+    # One limiter per model name is shared by every generator; limits given later replace the current ones.
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = _limiters[name] = RateLimiter(**kwargs)
+        limiter.configure(requests_per_minute, tokens_per_minute)
+        return limiter
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+KIND_BRANCH = "branch"
+KIND_SUBTREE = "subtree"
+
+
+def signature_key(kind: str, *parts) -> str:
+    encoded = json.dumps([kind] + list(parts), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class SubtreeLibrary:
+    # Persistent index of canonical subtree signatures shared by every tree that is generated or published.
+    # "branch" entries hold a RESULT branch expansion the generator can reuse instead of calling the model;
+    # "subtree" entries hold the stored node _ids of a published subtree the converter can seed new nodes from.
+    # Subclasses implement _load_many/_store_many; the first entry stored for a signature stays the canonical one.
+    def __init__(self):
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def _count(self, kind, **deltas):
+        counter = self.counters.setdefault(kind, {"lookups": 0, "hits": 0, "bytes_saved": 0, "stored": 0})
+        for name, delta in deltas.items():
+            counter[name] += delta
+
+    def get(self, kind: str, key: str):
+        with self._lock:
+            value = self._load_many([key]).get(key)
+            self._count(kind, lookups=1, hits=int(value is not None))
+            return value
+
+    def get_many(self, kind: str, keys: list) -> dict:
+        with self._lock:
+            found = self._load_many(list(dict.fromkeys(keys))) if keys else {}
+            self._count(kind, lookups=len(keys), hits=sum(1 for key in keys if key in found))
+            return found
+
+    def put(self, kind: str, key: str, value: str):
+        self.put_many(kind, {key: value})
+
+    def put_many(self, kind: str, entries: dict):
+        with self._lock:
+            if entries:
+                self._count(kind, stored=self._store_many(entries, kind, time.time()))
+
+    def saved(self, kind: str, nbytes: int):
+        # Called by the user of an entry with the number of bytes it did not have to regenerate or re-enter.
+        with self._lock:
+            self._count(kind, bytes_saved=nbytes)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {kind: dict(counter, hit_rate=counter["hits"] / counter["lookups"] if counter["lookups"] else 0.0)
+                    for kind, counter in self.counters.items()}
+
+    def _load_many(self, keys) -> dict:
+        raise NotImplementedError
+
+    def _store_many(self, entries, kind, now) -> int:
+        raise NotImplementedError
+
+
+class SQLiteSubtreeLibrary(SubtreeLibrary):
+    def __init__(self, path: str = "subtree_library.sqlite"):
+        super().__init__()
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS subtrees ("
+            "key TEXT PRIMARY KEY, kind TEXT NOT NULL, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def _load_many(self, keys) -> dict:
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            found.update(self.conn.execute(
+                f"SELECT key, value FROM subtrees WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall())
+        return found
+
+    def _store_many(self, entries, kind, now) -> int:
+        before = self.conn.total_changes
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO subtrees (key, kind, value, created_at) VALUES (?, ?, ?, ?)",
+            [(key, kind, value, now) for key, value in entries.items()],
+        )
+        self.conn.commit()
+        return self.conn.total_changes - before
+
+    def close(self):
+        self.conn.close()
+
+
+class MongoSubtreeLibrary(SubtreeLibrary):
+    # Same index in a collection next to the trees, so every worker publishing to that database shares it.
+    def __init__(self, client, database: str = "doctreen", collection: str = "subtree_library"):
+        super().__init__()
+        self.collection = client[database][collection]
+
+    def _load_many(self, keys) -> dict:
+        return {doc["_id"]: doc["value"] for doc in self.collection.find({"_id": {"$in": keys}}, {"value": 1})}
+
+    def _store_many(self, entries, kind, now) -> int:
+        from pymongo import UpdateOne
+        result = self.collection.bulk_write([
+            UpdateOne({"_id": key}, {"$setOnInsert": {"kind": kind, "value": value, "created_at": now}}, upsert=True)
+            for key, value in entries.items()
+        ], ordered=False)
+        return result.upserted_count
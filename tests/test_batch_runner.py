@@ -0,0 +1,91 @@
+import os
+import pytest
+from batch_runner import (BatchRunner, load_manifest, STATUS_FAILED, STATUS_GENERATED, STATUS_PUBLISHED,
+                          STATUS_PUBLISH_FAILED)
+
+pytest.importorskip("langchain")
+
+JOB = {"id": "thyroid/nodule", "file_type": "Thyroid ultrasound", "diseases": ["Nodule"], "provider": "fake",
+       "tree_name": "thyroid", "owner_id": "679fc806c5dab815f7995fb8"}
+
+
+class RecordingRunner(BatchRunner):
+    # Counts generations and publishes instead of writing to MongoDB; publishing fails while fail_publish is set.
+    def __init__(self, *args, fail_publish=False, fail_generate=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail_publish = fail_publish
+        self.fail_generate = fail_generate
+        self.generated = 0
+        self.published = []
+
+    def generate(self, job):
+        self.generated += 1
+        if self.fail_generate:
+            raise RuntimeError("model unavailable")
+        return super().generate(job)
+
+    def publish_tree(self, job, tree):
+        if self.fail_publish:
+            raise ConnectionError("mongo unavailable")
+        self.published.append(len(tree))
+        self.state.update(job["id"], status=STATUS_PUBLISHED, publish_error=None)
+
+
+def make_runner(tmp_path, **kwargs):
+    return RecordingRunner(str(tmp_path / "state.json"), str(tmp_path / "trees"), max_workers=1, **kwargs)
+
+
+def test_failed_publish_resumes_from_the_saved_tree(tmp_path):
+    runner = make_runner(tmp_path, fail_publish=True)
+    state = runner.run_job(dict(JOB))
+    assert state["status"] == STATUS_PUBLISH_FAILED
+    assert "mongo unavailable" in state["publish_error"]
+    assert os.path.exists(state["tree_file"])
+    # A new process reads the state file and publishes the saved tree without generating it again.
+    restarted = make_runner(tmp_path)
+    state = restarted.run_job(dict(JOB))
+    assert state["status"] == STATUS_PUBLISHED and state["publish_error"] is None
+    assert restarted.generated == 0
+    assert restarted.published == [state["nodes"]]
+    # Published jobs are skipped.
+    assert make_runner(tmp_path).run([dict(JOB)]) == {STATUS_PUBLISHED: 1}
+
+
+def test_generate_only_runs_skip_generated_jobs(tmp_path):
+    runner = make_runner(tmp_path, publish=False)
+    assert runner.run([dict(JOB)]) == {STATUS_GENERATED: 1}
+    rerun = make_runner(tmp_path, publish=False)
+    assert rerun.run([dict(JOB)]) == {STATUS_GENERATED: 1}
+    assert rerun.generated == 0
+    # Publishing later picks up the tree that was generated earlier.
+    publisher = make_runner(tmp_path)
+    assert publisher.run([dict(JOB)]) == {STATUS_PUBLISHED: 1}
+    assert publisher.generated == 0
+
+
+def test_failed_generation_is_retried(tmp_path):
+    runner = make_runner(tmp_path, fail_generate=True)
+    state = runner.run_job(dict(JOB))
+    assert state["status"] == STATUS_FAILED and "model unavailable" in state["error"]
+    retry = make_runner(tmp_path)
+    assert retry.run_job(dict(JOB))["status"] == STATUS_PUBLISHED
+    assert retry.generated == 1
+
+
+def test_load_manifest_fills_defaults(tmp_path):
+    path = tmp_path / "jobs.jsonl"
+    path.write_text('{"file_type": "Thyroid ultrasound", "diseases": "Nodule, Echo", "tree_name": "t1"}\n\n'
+                    '{"id": "x", "file_type": "Knee MRI", "diseases": ["Tear"], "provider": "fake"}\n')
+    jobs = load_manifest(str(path))
+    assert [job["id"] for job in jobs] == ["t1", "x"]
+    assert jobs[0]["diseases"] == ["Nodule", "Echo"] and jobs[0]["provider"] == "gemini"
+    assert jobs[1]["tree_name"] == "x"
+
+
+def test_unknown_provider_fails_the_job(tmp_path):
+    runner = make_runner(tmp_path)
+    with pytest.raises(ValueError):
+        runner.build_generator(dict(JOB, provider="openai"))
+    state = runner.run_job(dict(JOB, provider="openai"))
+    assert state["status"] == STATUS_FAILED and "unknown provider" in state["error"]
+    assert runner.generated == 1
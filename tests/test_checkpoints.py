@@ -0,0 +1,76 @@
+import json
+import pytest
+from checkpoints import IterationCheckpoints, fingerprint
+from fake_model import FakeChatModel
+from treeGenerator import CombinedMedicalTreeGenerator
+
+
+class FailingChatModel(FakeChatModel):
+    # Answers like FakeChatModel but raises once, on its fail_at-th call.
+    def __init__(self, fail_at, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_at = fail_at
+
+    def _respond(self, messages):
+        if self.fail_at is not None and self.calls + 1 == self.fail_at:
+            self.fail_at = None
+            raise RuntimeError("model unavailable")
+        return super()._respond(messages)
+
+
+def test_restore_requires_the_same_context(tmp_path):
+    checkpoints = IterationCheckpoints(str(tmp_path), "job")
+    checkpoints.save("RESULT", 0, "round 0", "context-a")
+    checkpoints.save("RESULT", 1, "round 1", "context-a")
+    # A retried round replaces itself and everything after it.
+    checkpoints.save("RESULT", 1, "round 1 again", "context-a")
+    reopened = IterationCheckpoints(str(tmp_path), "job")
+    assert reopened.restore("RESULT", "context-a") == ["round 0", "round 1 again"]
+    assert reopened.restore("RESULT", "context-b") == []
+    assert reopened.restore("INDICATION", "context-a") == []
+    reopened.clear()
+    assert IterationCheckpoints(str(tmp_path), "job").restore("RESULT", "context-a") == []
+    assert fingerprint("a", ["b"]) == fingerprint("a", ["b"]) != fingerprint("a", ["c"])
+
+
+def relabel(tree):
+    # Local node IDs follow parse order, which changes when a section is restored instead of streamed;
+    # they are replaced by each node's position so only the tree itself is compared.
+    position = {node["id"]: str(index) for index, node in enumerate(tree)}
+    return json.dumps([dict(node, id=position[node["id"]],
+                            parent=node["parent"] and dict(node["parent"], id=position[node["parent"]["id"]]),
+                            childs=[dict(child, id=position[child["id"]]) for child in node["childs"]])
+                       for node in tree])
+
+
+@pytest.mark.parametrize("fail_at", [3, 7, 11])
+def test_failed_run_resumes_from_the_last_round(tmp_path, fail_at):
+    pytest.importorskip("langchain")
+
+    def generator(model, **kwargs):
+        return CombinedMedicalTreeGenerator("Thyroid ultrasound", ["Nodule"], model=model, parallel=False, **kwargs)
+
+    reference_model = FakeChatModel(breadth=2, depth=3)
+    expected = generator(reference_model).run()
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    with pytest.raises(RuntimeError):
+        generator(FailingChatModel(fail_at, breadth=2, depth=3), checkpoint_dir=checkpoint_dir, job_key="job").run()
+    # Rounds finished before the failure are restored instead of being asked for again.
+    model = FakeChatModel(breadth=2, depth=3)
+    resumed = generator(model, checkpoint_dir=checkpoint_dir, job_key="job").run()
+    assert relabel(resumed) == relabel(expected)
+    assert model.calls == reference_model.calls - (fail_at - 1)
+    # A finished run removes its checkpoints.
+    assert not (tmp_path / "checkpoints" / "job.json").exists()
+
+
+def test_changed_inputs_are_not_resumed(tmp_path):
+    pytest.importorskip("langchain")
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    with pytest.raises(RuntimeError):
+        CombinedMedicalTreeGenerator("Thyroid ultrasound", ["Nodule"], model=FailingChatModel(8, breadth=2, depth=3),
+                                     parallel=False, checkpoint_dir=checkpoint_dir, job_key="job").run()
+    model = FakeChatModel(breadth=2, depth=3)
+    CombinedMedicalTreeGenerator("Thyroid ultrasound", ["Echo"], model=model, parallel=False,
+                                 checkpoint_dir=checkpoint_dir, job_key="job").run()
+    assert model.calls == 11
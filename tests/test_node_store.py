@@ -0,0 +1,120 @@
+import copy
+import json
+import random
+import pytest
+from treeGenerator import CombinedMedicalTreeGenerator
+from node_store import NodeStore
+from fake_model import FakeChatModel
+
+WORDS = ("Yes", "No", "Size", "Nodule?", "Left", "Right")
+SUFFIXES = ("", " (TYPE_QCS)", " (TYPE_TOPIC)")
+
+
+def make_generator():
+    return CombinedMedicalTreeGenerator("Thyroid ultrasound", [], model=FakeChatModel())
+
+
+def random_section(rng, title):
+    # Few distinct labels, so identical subtrees (and identical siblings) are common. Some sections
+    # are empty or have extra parentless lines, like badly formatted model output.
+    if rng.random() < 0.05:
+        return ""
+    lines = [f"{title}: (TYPE_TITLE)"]
+    lowest = 0 if rng.random() < 0.2 else 1
+    depth = 0
+    for _ in range(rng.randint(0, 40)):
+        depth = max(lowest, min(depth + rng.choice((-2, -1, 0, 1, 1)), 6))
+        lines.append("    " * depth + rng.choice(("- ", "")) + rng.choice(WORDS) + rng.choice(SUFFIXES))
+    return "\n".join(lines)
+
+
+def random_forest(seed):
+    rng = random.Random(seed)
+    return [random_section(rng, title) for title in ("INDICATION", "TECHNIQUE", "RESULT")]
+
+
+def legacy_tree(texts):
+    # The original pipeline: deduplicate each section's node dicts, combine them under a new root
+    # (which deduplicates again) and transform the result.
+    generator = make_generator()
+    sections = [generator.deduplicate_nodes(generator.parse_indentation_tree(text))[0] for text in texts]
+    combined = generator.combine_trees(*[list(section.values()) for section in sections])
+    return list(generator.transform_nodes(combined).values())
+
+
+def reference_deduplicate(nodes_list):
+    # deduplicate_nodes as it was written originally, with recursive nested-tuple signatures.
+    node_dict = {node["id"]: node for node in nodes_list}
+    memo = {}
+    signature_map = {}
+    alias_mapping = {}
+
+    def get_signature(node_id):
+        if node_id in memo:
+            return memo[node_id]
+        node = node_dict[node_id]
+        child_signatures = tuple(get_signature(child_id) for child_id in node["childs"])
+        memo[node_id] = (node["text"], node["nodeType"], node.get("parentText"), child_signatures)
+        return memo[node_id]
+
+    for node_id in node_dict:
+        sig = get_signature(node_id)
+        signature_map.setdefault(sig, node_id)
+        alias_mapping[node_id] = signature_map[sig]
+    for node in node_dict.values():
+        node["childs"] = list(dict.fromkeys(alias_mapping[child_id] for child_id in node["childs"]))
+    dedup_node_dict = {}
+    for canonical_id in alias_mapping.values():
+        dedup_node_dict.setdefault(canonical_id, node_dict[canonical_id])
+    return dedup_node_dict, alias_mapping
+
+
+def dump(value):
+    return json.dumps(value, sort_keys=True)
+
+
+@pytest.mark.parametrize("block", range(10))
+def test_fuse_matches_legacy_pipeline(block):
+    for seed in range(block * 200, (block + 1) * 200):
+        texts = random_forest(seed)
+        assert dump(make_generator().assemble_tree(*texts)) == dump(legacy_tree(texts)), texts
+
+
+def test_section_digests_keep_first_occurrences():
+    for seed in range(300):
+        text = random_forest(seed)[2]
+        generator = make_generator()
+        store = generator.parse_indentation_store(text)
+        live_rows, children, _, section_root = store.section_digests("Thyroid ultrasound")
+        dedup, _ = generator.deduplicate_nodes(make_generator().parse_indentation_tree(text))
+        assert [str(store.ids[row]) for row in live_rows] == list(dedup)
+        assert [[str(store.ids[kid]) for kid in children[row]] for row in live_rows] == [node["childs"] for node in dedup.values()]
+        assert (section_root is None) == (not text)
+
+
+def test_deduplicate_nodes_matches_reference():
+    generator = make_generator()
+    for seed in range(2000):
+        nodes = generator.parse_indentation_tree(random_forest(seed)[2])
+        expected = reference_deduplicate(copy.deepcopy(nodes))
+        assert dump(generator.deduplicate_nodes(copy.deepcopy(nodes))) == dump(expected)
+
+
+def test_deduplicate_nodes_handles_deep_chains():
+    # Far deeper than the recursion limit; the digests are computed with an explicit stack.
+    generator = make_generator()
+    depth = 5000
+    nodes = generator.parse_indentation_tree("\n".join("  " * level + f"n{level}" for level in range(depth)))
+    dedup, alias_mapping = generator.deduplicate_nodes(nodes)
+    assert len(dedup) == depth
+    assert all(node_id == canonical_id for node_id, canonical_id in alias_mapping.items())
+    repeated = generator.parse_indentation_tree("\n".join(("  " * level + "same") for level in range(depth)))
+    assert len(generator.deduplicate_nodes(repeated)[0]) == depth
+
+
+def test_store_digests_match_node_digests():
+    generator = make_generator()
+    for seed in range(200):
+        nodes = generator.parse_indentation_tree(random_forest(seed)[0])
+        signatures = generator.compute_signatures({node["id"]: node for node in nodes})
+        assert NodeStore.from_nodes(nodes).compute_digests() == [signatures[node["id"]] for node in nodes]
@@ -0,0 +1,97 @@
+import glob
+import json
+import os
+import pytest
+from treeGenerator import CombinedMedicalTreeGenerator, IncrementalTreeParser, IncrementalStoreParser
+from node_store import NodeStore
+from fake_model import FakeChatModel
+
+# Each <case>.txt is an indented model response; <case>.json holds the node dicts the original
+# regex-based parse_indentation_tree produced for it, so the tokenizer must reproduce them byte for byte.
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), "golden", "parse_indentation_tree")
+CASES = sorted(os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(GOLDEN_DIR, "*.txt")))
+
+
+def load_case(case):
+    with open(os.path.join(GOLDEN_DIR, f"{case}.txt"), encoding="utf-8") as f:
+        text = f.read()
+    with open(os.path.join(GOLDEN_DIR, f"{case}.json"), encoding="utf-8") as f:
+        expected = json.load(f)
+    return text, expected
+
+
+def make_generator():
+    return CombinedMedicalTreeGenerator("Thyroid ultrasound", [], model=FakeChatModel())
+
+
+def dump(nodes):
+    return json.dumps(nodes, indent=2, ensure_ascii=False)
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_parse_matches_golden(case):
+    text, expected = load_case(case)
+    assert dump(make_generator().parse_indentation_tree(text)) == dump(expected)
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_streaming_lines_match_golden(case):
+    # Nodes are yielded as their line arrives; children are attached to them afterwards.
+    text, expected = load_case(case)
+    yielded = []
+    for node in make_generator().iter_indentation_tree(iter(text.splitlines())):
+        assert node["childs"] == []
+        yielded.append(node)
+    assert dump(yielded) == dump(expected)
+
+
+@pytest.mark.parametrize("case", CASES)
+@pytest.mark.parametrize("chunk_size", [1, 7, 64])
+def test_streamed_chunks_match_parse(case, chunk_size):
+    # Streaming the raw response in chunks gives the same nodes as parsing the extracted section.
+    text, _ = load_case(case)
+    generator = make_generator()
+    expected = generator.parse_indentation_tree(generator.extract_section(text))
+    parser = IncrementalTreeParser(make_generator())
+    for start in range(0, len(text), chunk_size):
+        parser.feed(text[start:start + chunk_size])
+    assert dump(parser.close()) == dump(expected)
+
+
+def test_golden_cases_present():
+    assert {"brackets", "indentation", "blank_garbage", "type_suffixes"} <= set(CASES)
+
+
+def store_columns(store):
+    return {name: list(getattr(store, name)) for name in NodeStore.__slots__ if name != "string_index"}
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_store_parser_matches_packed_nodes(case):
+    # Parsing straight into a NodeStore gives the same columns as packing the parsed node dicts.
+    text, _ = load_case(case)
+    expected = NodeStore.from_nodes(make_generator().parse_indentation_tree(text))
+    assert store_columns(make_generator().parse_indentation_store(text)) == store_columns(expected)
+    parser = IncrementalStoreParser(make_generator())
+    for start in range(0, len(text), 7):
+        parser.feed(text[start:start + 7])
+    generator = make_generator()
+    streamed_expected = NodeStore.from_nodes(generator.parse_indentation_tree(generator.extract_section(text)))
+    assert store_columns(parser.close()) == store_columns(streamed_expected)
+
+
+@pytest.mark.parametrize("text", [
+    "Exam (TYPE_TITLE)\n<think>unfinished\n    Finding (TYPE_TOPIC)\n        Size (TYPE_QUESTION)\n",
+    "<think>\nRESULT (TYPE_TITLE)\n    Nodule (TYPE_TOPIC)",
+    "A (TYPE_TITLE)\n    B <think>x</think> (TYPE_TOPIC)\n    C <think>open\n        D (TYPE_QUESTION)",
+    "A (TYPE_TITLE)\n    B <think>closed\n    </think> (TYPE_TOPIC)\n    C <think>open\n    E (TYPE_TOPIC)",
+])
+@pytest.mark.parametrize("chunk_size", [1, 5, 1000])
+def test_unclosed_think_block_is_kept(text, chunk_size):
+    # extract_section leaves an unclosed <think> in the text, so its lines still become nodes.
+    generator = make_generator()
+    expected = generator.parse_indentation_tree(generator.extract_section(text))
+    parser = IncrementalTreeParser(make_generator())
+    for start in range(0, len(text), chunk_size):
+        parser.feed(text[start:start + chunk_size])
+    assert dump(parser.close()) == dump(expected)
@@ -0,0 +1,109 @@
+import copy
+import random
+from custom2doctreen_parser import CustomToDoctreenConverter
+
+
+def make_converter():
+    # plan_update only compares labels and parents, so no database connection is needed.
+    converter = CustomToDoctreenConverter.__new__(CustomToDoctreenConverter)
+    converter.owner_object_id = None
+    return converter
+
+
+def node(node_id, text, node_type, parent=None):
+    return {"id": node_id, "text": text, "nodeType": node_type,
+            "parent": {"id": parent["id"], "text": parent["text"]} if parent is not None else None, "childs": []}
+
+
+def build_tree(spec):
+    # spec: (id, text, type, parent id) tuples in document order.
+    nodes = {}
+    for node_id, text, node_type, parent_id in spec:
+        nodes[node_id] = node(node_id, text, node_type, nodes.get(parent_id))
+        if parent_id is not None:
+            nodes[parent_id]["childs"].append({"id": node_id, "text": text})
+    return list(nodes.values())
+
+
+def stored_documents(converter, custom_nodes):
+    # What a previous publish of custom_nodes left in the treenodes collection.
+    idMap = {item["id"]: f"uuid-{item['id']}" for item in custom_nodes}
+    return [converter.build_node_document(item, idMap, f"oid-{item['id']}") for item in custom_nodes]
+
+
+BASE = [
+    ("r", "Thyroid ultrasound", "TYPE_ROOT", None),
+    ("res", "RESULT", "TYPE_TITLE", "r"),
+    ("lobe1", "Lobe", "TYPE_TOPIC", "res"),
+    ("size1", "Size", "TYPE_QUESTION", "lobe1"),
+    ("lobe2", "Lobe", "TYPE_TOPIC", "res"),
+    ("size2", "Size", "TYPE_QUESTION", "lobe2"),
+    ("yes", "Yes", "TYPE_QCS", "size2"),
+]
+
+
+def test_unchanged_tree_matches_every_node():
+    converter = make_converter()
+    tree = build_tree(BASE)
+    matched, removed = converter.plan_update(copy.deepcopy(tree), stored_documents(converter, tree))
+    assert {node_id: doc["nodeId"] for node_id, doc in matched.items()} == {item["id"]: f"uuid-{item['id']}" for item in tree}
+    assert removed == []
+
+
+def test_same_label_siblings_match_in_order():
+    # Regenerated IDs differ, so the two "Lobe" branches are told apart by their occurrence number.
+    converter = make_converter()
+    stored = stored_documents(converter, build_tree(BASE))
+    regenerated = build_tree([(f"new-{node_id}", text, node_type, parent_id and f"new-{parent_id}")
+                              for node_id, text, node_type, parent_id in BASE])
+    matched, removed = converter.plan_update(regenerated, stored)
+    assert {node_id: doc["nodeId"] for node_id, doc in matched.items()} == {f"new-{node_id}": f"uuid-{node_id}" for node_id, *_ in BASE}
+    assert removed == []
+
+
+def test_renamed_branch_and_new_leaf():
+    converter = make_converter()
+    stored = stored_documents(converter, build_tree(BASE))
+    changed = [(node_id, "Isthmus" if node_id == "lobe2" else text, node_type, parent_id)
+               for node_id, text, node_type, parent_id in BASE]
+    changed.append(("no", "No", "TYPE_QCS", "size1"))
+    matched, removed = converter.plan_update(build_tree(changed), stored)
+    # The renamed branch and everything below it get new keys; the untouched first branch keeps its IDs.
+    assert set(matched) == {"r", "res", "lobe1", "size1"}
+    assert sorted(doc["nodeId"] for doc in removed) == ["uuid-lobe2", "uuid-size2", "uuid-yes"]
+
+
+def test_type_changes_follow_the_stored_node_type():
+    # Stored documents hold the doctreen type (TYPE_NODE), so a topic that became a question still matches.
+    converter = make_converter()
+    stored = stored_documents(converter, build_tree(BASE))
+    retyped = [(node_id, text, "TYPE_QUESTION" if node_type == "TYPE_TOPIC" else node_type, parent_id)
+               for node_id, text, node_type, parent_id in BASE]
+    matched, removed = converter.plan_update(build_tree(retyped), stored)
+    assert len(matched) == len(BASE) and removed == []
+
+
+def test_random_edits_keep_keys_of_untouched_paths():
+    rng = random.Random(7)
+    converter = make_converter()
+    for _ in range(200):
+        spec = [("0", "root", "TYPE_ROOT", None)]
+        for index in range(1, rng.randint(2, 30)):
+            spec.append((str(index), rng.choice(("A", "B", "C")), rng.choice(("TYPE_TOPIC", "TYPE_QCS")),
+                         rng.choice(spec)[0]))
+        stored = stored_documents(converter, build_tree(spec))
+        # Drop one subtree; every remaining path still exists in the stored tree, so all of it matches.
+        dropped = {rng.choice(spec[1:])[0]}
+        kept = []
+        for item in spec:
+            if item[0] in dropped or item[3] in dropped:
+                dropped.add(item[0])
+            else:
+                kept.append(item)
+        matched, removed = converter.plan_update(build_tree(kept), stored)
+        assert set(matched) == {item[0] for item in kept}
+        assert len(removed) == len(spec) - len(kept)
+        # Every matched node is paired with a stored node that has the same label.
+        for node_id, doc in matched.items():
+            text = next(item[1] for item in kept if item[0] == node_id)
+            assert doc["alias"] == text
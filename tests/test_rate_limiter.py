@@ -0,0 +1,40 @@
+from rate_limiter import get_rate_limiter, is_retryable
+
+
+class ApiError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class ResourceExhausted(Exception):
+    pass
+
+
+def test_retryable_errors_are_matched_by_status_or_type():
+    assert is_retryable(ApiError("quota exceeded", code=429))
+    assert is_retryable(ApiError("backend unavailable", code=503))
+    assert is_retryable(ResourceExhausted("slow down"))
+    # The message alone never makes an error retryable.
+    assert not is_retryable(ValueError("node 429 not found"))
+    assert not is_retryable(ApiError("rate limit in the prompt", code=400))
+
+
+def test_wrapped_errors_are_matched_by_their_cause():
+    try:
+        try:
+            raise ResourceExhausted("quota")
+        except ResourceExhausted as e:
+            raise RuntimeError("Error calling model") from e
+    except RuntimeError as e:
+        assert is_retryable(e)
+
+
+def test_limits_apply_to_an_existing_limiter():
+    limiter = get_rate_limiter("test-model")
+    assert get_rate_limiter("test-model", requests_per_minute=30, tokens_per_minute=1000) is limiter
+    assert (limiter.requests.capacity, limiter.tokens.capacity) == (30, 1000)
+    assert limiter.requests.level <= 30
+    # Leaving a limit out keeps the current one.
+    get_rate_limiter("test-model", requests_per_minute=10)
+    assert (limiter.requests.capacity, limiter.tokens.capacity) == (10, 1000)
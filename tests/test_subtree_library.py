@@ -0,0 +1,36 @@
+from treeGenerator import CombinedMedicalTreeGenerator
+from fake_model import FakeChatModel
+from subtree_library import SQLiteSubtreeLibrary, KIND_BRANCH
+
+BRANCH = ["    Nodule: (TYPE_TOPIC)", "        Size? (TYPE_QUESTION)", "            - Small (TYPE_QCS)"]
+
+
+def signature(file_type="Thyroid ultrasound", diseases=("Nodule",), branch=BRANCH, **kwargs):
+    generator = CombinedMedicalTreeGenerator(file_type, list(diseases), model=FakeChatModel(), **kwargs)
+    return generator.branch_signature(branch, 1)
+
+
+def test_branch_signature_is_scoped_to_the_exam_by_default():
+    assert signature() == signature()
+    assert signature() != signature(file_type="Liver MRI")
+    assert signature() != signature(diseases=("Goiter",))
+    # Indentation is relative and labels are normalised, so a re-indented copy is the same branch.
+    assert signature() == signature(branch=[line[4:] for line in BRANCH])
+    assert signature() != signature(branch=BRANCH[:2])
+
+
+def test_shared_branches_ignore_the_exam_but_not_the_prompt_mode():
+    shared = signature(share_branches=True)
+    assert shared == signature(file_type="Liver MRI", diseases=("Goiter",), share_branches=True)
+    assert shared != signature()
+    assert shared != signature(share_branches=True, compact_prompts=True)
+
+
+def test_library_keeps_the_first_entry(tmp_path):
+    library = SQLiteSubtreeLibrary(str(tmp_path / "library.sqlite"))
+    library.put(KIND_BRANCH, "key", "first")
+    library.put(KIND_BRANCH, "key", "second")
+    assert library.get(KIND_BRANCH, "key") == "first"
+    assert library.get_many(KIND_BRANCH, ["key", "missing"]) == {"key": "first"}
+    stats = library.stats()[KIND_BRANCH]
+    assert (stats["lookups"], stats["hits"], stats["stored"]) == (3, 2, 1)
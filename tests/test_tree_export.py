@@ -0,0 +1,47 @@
+import json
+import pytest
+import tree_export
+from test_node_store import make_generator, random_forest
+
+
+def sample_trees():
+    trees = [make_generator().assemble_tree(*random_forest(seed)) for seed in range(20)]
+    # IDs are not always numeric strings, and texts may repeat, be empty or hold any unicode.
+    trees.append([
+        {"id": "0042", "nodeType": "TYPE_ROOT", "text": "Échographie thyroïdienne", "isLeaf": False, "parent": None,
+         "childs": [{"id": "a-1", "text": ""}, {"id": "7", "text": "Taille (mm)"}]},
+        {"id": "a-1", "nodeType": "TYPE_TITLE", "text": "", "isLeaf": True,
+         "parent": {"id": "0042", "text": "Échographie thyroïdienne"}, "childs": []},
+        {"id": "7", "nodeType": "TYPE_QCS", "text": "Taille (mm)", "isLeaf": True,
+         "parent": {"id": "0042", "text": "Échographie thyroïdienne"}, "childs": []},
+    ])
+    trees.append([])
+    return trees
+
+
+@pytest.mark.parametrize("fmt", ["json", "ndjson", "msgpack"])
+def test_round_trip(tmp_path, fmt):
+    if fmt == "msgpack":
+        pytest.importorskip("msgpack")
+    for index, tree in enumerate(sample_trees()):
+        path = str(tmp_path / f"tree{index}.{fmt}")
+        size = tree_export.save_tree(iter(tree), path)
+        assert size > 0
+        assert json.dumps(tree_export.load_tree(path)) == json.dumps(tree)
+        # Without an extension the format is detected from the content.
+        bare_path = str(tmp_path / f"tree{index}_{fmt}")
+        tree_export.save_tree(tree, bare_path, fmt)
+        assert json.dumps(tree_export.load_tree(bare_path)) == json.dumps(tree)
+
+
+def test_ndjson_reads_across_chunks(tmp_path):
+    tree = make_generator().assemble_tree(*random_forest(3))
+    path = str(tmp_path / "tree.ndjson")
+    tree_export.save_tree(tree, path)
+    with open(path, encoding="utf-8") as f:
+        assert list(tree_export.read_ndjson(f, chunk_lines=3)) == tree
+
+
+def test_unknown_format_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        tree_export.save_tree([], str(tmp_path / "tree.bin"), "xml")
@@ -0,0 +1,33 @@
+import os
+import time
+import pytest
+from tree_render import TreeRenderer, dot_source, find_roots
+
+
+def node(node_id, text, parent=None, childs=()):
+    return {"id": node_id, "text": text, "nodeType": "TYPE_TOPIC", "parent": parent and {"id": parent, "text": ""},
+            "childs": [{"id": child, "text": ""} for child in childs]}
+
+
+def test_whole_tree_view_draws_every_root():
+    pytest.importorskip("graphviz")
+    nodes = [node("1", "First root", childs=["2"]), node("2", "Child", parent="1"), node("3", "Second root")]
+    assert find_roots({n["id"]: n for n in nodes}) == ["1", "3"]
+    source = dot_source(nodes)
+    assert "First root" in source and "Child" in source and "Second root" in source
+    assert "Second root" in dot_source(nodes, max_depth=0)
+    assert "Second root" not in dot_source(nodes, root_id="1")
+
+
+def test_cache_evicts_least_recently_used_files(tmp_path):
+    renderer = TreeRenderer(str(tmp_path), max_cache_bytes=25)
+    paths = [str(tmp_path / f"{name}.svg") for name in "abc"]
+    for age, path in enumerate(paths):
+        with open(path, "wb") as f:
+            f.write(b"x" * 10)
+        os.utime(path, (time.time() - 100 + age, time.time() - 100 + age))
+    # "a" is used again, so "b" is now the least recently used file.
+    os.utime(paths[0])
+    renderer.evict(keep=paths[2])
+    assert [os.path.exists(path) for path in paths] == [True, False, True]
+    renderer.close()
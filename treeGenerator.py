@@ -1,30 +1,386 @@
 import re
+import asyncio
+import logging
+import threading
+import time
+import uuid
 # import os
 # import json
-from graphviz import Digraph
-from langchain.schema import SystemMessage, HumanMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
-import streamlit as st
+# graphviz, langchain and streamlit are imported where they are used, so importing this module stays cheap.
+from llm_cache import make_cache_key
+from rate_limiter import get_rate_limiter, estimate_tokens
+from checkpoints import IterationCheckpoints, fingerprint
+from node_store import NodeStore, NO_PARENT, merkle_digest
+from prompt_compaction import PromptCompactor, prompt_tokens, add_usage
+from metrics import get_tracer
+from config import api_key, rate_limits
+from progress import NullProgress
+from async_support import run_sync, with_timeout, gather_or_cancel, ainvoke_model, astream_model
+from subtree_library import KIND_BRANCH, signature_key
+import tree_export
+import tree_render
 # from tqdm import tqdm
 
-API_KEY = st.secrets["general"]["api_key"]
+logger = logging.getLogger(__name__)
+
+class IndentationTreeBuilder:
+    # Holds the indentation stack so lines can be added one at a time; new_node decides how a node is kept.
+    def __init__(self, generator):
+        super().__init__()
+        self.generator = generator
+        self.stack = []
+        self.nodes = []
+        self.count = 0
+
+    def add_line(self, line: str):
+        token = self.generator.tokenize_line(line)
+        if token is None:
+            return None
+        indent, new_text, node_type_extracted, is_list_item = token
+        stack = self.stack
+        if node_type_extracted is not None:
+            node_type = node_type_extracted
+        else:
+            if not stack:
+                node_type = "root"
+            else:
+                if new_text.endswith('?'):
+                    node_type = "question"
+                elif is_list_item:
+                    node_type = "option"
+                else:
+                    node_type = "node"
+        while stack and indent <= stack[-1][1]:
+            stack.pop()
+        node = self.new_node(self.generator.next_node_id(), node_type, new_text, stack[-1][0] if stack else None)
+        stack.append((node, indent))
+        self.count += 1
+        return node
+
+    def new_node(self, node_id, node_type, text, parent):
+        node = {
+            "id": node_id,
+            "nodeType": node_type,
+            "text": text,
+            "isLeaf": True,
+            "parent": parent["id"] if parent is not None else None,
+            "parentText": parent["text"] if parent is not None else None,
+            "childs": []
+        }
+        if parent is not None:
+            parent["childs"].append(node_id)
+            parent["isLeaf"] = False
+        self.nodes.append(node)
+        return node
+
+    def finish(self):
+        return self.nodes
+
+class StoreTreeBuilder(IndentationTreeBuilder):
+    # Appends parsed lines straight to a NodeStore, so a section is never held as per-node dicts.
+    # The stack holds row numbers instead of nodes.
+    def __init__(self, generator):
+        super().__init__(generator)
+        self.store = NodeStore()
+
+    def new_node(self, node_id, node_type, text, parent):
+        return self.store.append_parsed(int(node_id), text, node_type, NO_PARENT if parent is None else parent)
+
+    def finish(self) -> NodeStore:
+        self.store.link_children()
+        return self.store
+
+class IncrementalTreeParser(IndentationTreeBuilder):
+    # Accepts streamed text chunks and parses every completed line, applying the same
+    # clean-up as extract_section (think blocks, code fences, leading whitespace).
+    def __init__(self, generator):
+        super().__init__(generator)
+        self.buffer = ""
+        self.in_think = False
+        self.think_prefix = ""
+        # Raw lines of the open think block, parsed as plain text if the block is never closed.
+        self.think_lines = []
+        self.started = False
+
+    def feed(self, chunk: str) -> int:
+        self.buffer += chunk
+        pieces = self.buffer.splitlines(keepends=True)
+        self.buffer = ""
+        if pieces and pieces[-1].splitlines()[0] == pieces[-1]:
+            self.buffer = pieces.pop()
+        added = 0
+        for piece in pieces:
+            added += self._add_clean_line(piece.splitlines()[0])
+        return added
+
+    def close(self):
+        if self.buffer:
+            self._add_clean_line(self.buffer)
+            self.buffer = ""
+        if self.in_think:
+            # extract_section only strips closed think blocks, so an unclosed one is kept as tree text.
+            self.in_think = False
+            for line in self.think_lines:
+                self._add_text_line(line)
+            self.think_lines = []
+        return self.finish()
+
+    def _add_clean_line(self, line: str) -> int:
+        if self.in_think:
+            if "</think>" not in line:
+                self.think_lines.append(line)
+                return 0
+            # Text around a multi-line think block ends up on a single line.
+            self.in_think = False
+            self.think_lines = []
+            line = self.think_prefix + line.split("</think>", 1)[1]
+        line = re.sub(r'<think>.*?</think>', '', line)
+        if "<think>" in line:
+            self.think_prefix, _ = line.split("<think>", 1)
+            self.think_lines = [line]
+            self.in_think = True
+            return 0
+        return self._add_text_line(line)
+
+    def _add_text_line(self, line: str) -> int:
+        if not self.started:
+            if not line.strip():
+                return 0
+            line = line.lstrip()
+            self.started = True
+        line = line.replace("```", "")
+        return 0 if self.add_line(line) is None else 1
+
+class IncrementalStoreParser(IncrementalTreeParser, StoreTreeBuilder):
+    # Streaming parser whose close() returns a NodeStore; used for the final round of each section.
+    pass
 
 class CombinedMedicalTreeGenerator:
-    def __init__(self, file_type: str, disease_context: list):
+    def __init__(self, file_type: str, disease_context: list, parallel: bool = True, cache=None, stream_final_iteration: bool = True, model=None, rate_limiter=None, checkpoint_dir=None, job_key=None, convergence_threshold=None, compact_prompts=False, result_fanout=False, branch_workers=4, tracer=None, subtree_library=None, share_branches=False, stage_timeouts=None, requests_per_minute=None, tokens_per_minute=None):
         self.file_type = file_type
         self.disease_context = disease_context
         self.indication_iterations = 5
         self.technical_iterations = 1
         self.result_iterations = 5
+        self.parallel = parallel
+        self.cache = cache
+        self.stream_final_iteration = stream_final_iteration
+        self.streamed_stores = {}
+        self.model_name = "gemini-2.0-flash"
+        self.temperature = 0.7
+        self.current_step = 0
+        self._step_lock = threading.Lock()
 
-        self.model = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
-            api_key=API_KEY,
-            temperature=0.7
-        )
+        self.rate_limiter = rate_limiter
+        if model is not None:
+            self.model = model
+            self.model_name = getattr(model, "model", self.model_name)
+        else:
+            from langchain_google_genai import ChatGoogleGenerativeAI
+            self.model = ChatGoogleGenerativeAI(
+                model=self.model_name,
+                api_key=api_key(),
+                temperature=self.temperature,
+                # Retries belong to the shared rate limiter; client-side retries would multiply its attempts
+                # and retry outside the request and token buckets.
+                max_retries=0
+            )
+            if self.rate_limiter is None:
+                # Limits not passed in come from the config; the limiter is shared by every generator of this model.
+                limits = rate_limits()
+                self.rate_limiter = get_rate_limiter(
+                    self.model_name,
+                    requests_per_minute=requests_per_minute if requests_per_minute is not None else limits["requests_per_minute"],
+                    tokens_per_minute=tokens_per_minute if tokens_per_minute is not None else limits["tokens_per_minute"])
+        # Relative node growth below which the remaining middle rounds are skipped; None disables it.
+        self.convergence_threshold = convergence_threshold
+        self.rounds_used = {}
+        # In compact mode refinement prompts carry a condensed outline and the model returns only additions.
+        self.compactor = PromptCompactor(self) if compact_prompts else None
+        self.round_stats = []
+        self.tracer = tracer if tracer is not None else get_tracer()
+        self.run_id = None
+        # After the RESULT outline round, each top-level branch can be refined in its own concurrent call.
+        self.result_fanout = result_fanout
+        self.branch_workers = branch_workers
+        # RESULT branch expansions kept in the library; a known branch is grafted instead of regenerated.
+        # By default a branch is only reused for the same exam and diseases; share_branches reuses it for
+        # any exam whose branch has the same outline.
+        self.subtree_library = subtree_library
+        self.share_branches = share_branches
+        # Seconds allowed per stage ("llm_round", "INDICATION", "TECHNIQUE", "RESULT"); a missing stage has no limit.
+        self.stage_timeouts = dict(stage_timeouts or {})
+        self.checkpoints = None
+        # Checkpointed rounds are only reused when they were generated from the same inputs.
+        self.checkpoint_context = fingerprint(self.file_type, self.disease_context, self.model_name, self.temperature)
+        if checkpoint_dir is not None:
+            self.checkpoints = IterationCheckpoints(checkpoint_dir, job_key or self.checkpoint_context)
         self.combined_json_filename = "combined_tree.json"
         self.combined_png_filename = "combined_tree"
         self.node_counter = 1
+        self._node_lock = threading.Lock()
+
+    async def _call_model(self, attempt, messages: list) -> str:
+        # Every model round goes through the shared rate limiter, which also retries quota errors.
+        # The llm_round timeout applies to each attempt.
+        timeout = self.stage_timeouts.get("llm_round")
+
+        async def timed_attempt():
+            return await with_timeout(attempt(), timeout, "llm_round")
+
+        if self.rate_limiter is None:
+            return await timed_attempt()
+        return await self.rate_limiter.acall(timed_attempt, estimate_tokens("".join(m.content for m in messages)))
+
+    async def _invoke(self, messages: list, usage: dict) -> str:
+        async def attempt():
+            response = await ainvoke_model(self.model, messages)
+            usage.clear()
+            add_usage(usage, response)
+            return response.content
+
+        if self.cache is None:
+            return await self._call_model(attempt, messages)
+        key = make_cache_key(self.model_name, self.temperature, messages)
+        content = self.cache.get(key)
+        if content is None:
+            content = await self._call_model(attempt, messages)
+            self.cache.set(key, content)
+        return content
+
+    async def _invoke_streaming(self, messages: list, section: str, iteration: int, stream_lit_bar, usage: dict) -> str:
+        # Feeds the response into an incremental parser while tokens arrive, so the final
+        # round's nodes are ready as soon as the call returns.
+        parsers = []
+
+        async def stream_attempt():
+            # A retried stream starts over with a fresh parser.
+            parser = IncrementalStoreParser(self)
+            parsers.append(parser)
+            parts = []
+            usage.clear()
+            async for chunk in astream_model(self.model, messages):
+                parts.append(chunk.content)
+                add_usage(usage, chunk)
+                if parser.feed(chunk.content):
+                    stream_lit_bar.progress(self.current_step/self.total_steps(),text=f"{section} iteration : {iteration+1} streaming, {parser.count} nodes received")
+            return "".join(parts)
+
+        key = make_cache_key(self.model_name, self.temperature, messages) if self.cache is not None else None
+        content = self.cache.get(key) if key is not None else None
+        if content is not None:
+            parser = IncrementalStoreParser(self)
+            parser.feed(content)
+        else:
+            content = await self._call_model(stream_attempt, messages)
+            parser = parsers[-1]
+            if key is not None:
+                self.cache.set(key, content)
+        self.streamed_stores[section] = parser.close()
+        return content
+
+    async def _invoke_round(self, messages: list, section: str, iteration: int, iterations: int, stream_lit_bar, stream: bool = True) -> str:
+        started = time.perf_counter()
+        streamed = stream and self.stream_final_iteration and iteration == iterations - 1
+        usage = {}
+        with self.tracer.span("llm_round", run=self.run_id, section=section, iteration=iteration, streamed=streamed,
+                              compact=self.compactor is not None, input_tokens=prompt_tokens(messages)) as span:
+            if streamed:
+                content = await self._invoke_streaming(messages, section, iteration, stream_lit_bar, usage)
+            else:
+                content = await self._invoke(messages, usage)
+            # Counts reported by the model are used when present; cache hits and models without
+            # usage_metadata fall back to the length estimate, which is flagged so it is not exported as a real count.
+            span["input_tokens"] = usage.get("input_tokens", span["input_tokens"])
+            span["output_tokens"] = usage.get("output_tokens", estimate_tokens(content))
+            span["tokens_estimated"] = not usage
+        self.round_stats.append({
+            "section": section,
+            "iteration": iteration,
+            "compact": span["compact"],
+            "input_tokens": span["input_tokens"],
+            "output_tokens": span["output_tokens"],
+            "tokens_estimated": span["tokens_estimated"],
+            "seconds": round(time.perf_counter() - started, 3),
+        })
+        return content
+
+    async def _refine(self, messages: list, section: str, iteration: int, iterations: int, previous_text, stream_lit_bar, stream: bool = True) -> str:
+        if self.compactor is None or previous_text is None:
+            return self.extract_section(await self._invoke_round(messages, section, iteration, iterations, stream_lit_bar, stream=stream))
+        # Compact rounds answer with additions only, so they are merged here instead of being streamed into the parser.
+        additions = self.extract_section(await self._invoke_round(messages, section, iteration, iterations, stream_lit_bar, stream=False))
+        return self.compactor.apply_diff(previous_text, additions)
+
+    def _previous_tree(self, section: str, text: str) -> str:
+        return text if self.compactor is None else self.compactor.refinement_block(section, text)
+
+    def _compact_instructions(self, section: str) -> str:
+        return "" if self.compactor is None else self.compactor.diff_instructions(section)
+
+    def prompt_stats(self) -> dict:
+        stats = {}
+        for entry in self.round_stats:
+            section = stats.setdefault(entry["section"], {"calls": 0, "estimated_calls": 0, "input_tokens": 0,
+                                                              "output_tokens": 0, "seconds": 0.0})
+            section["calls"] += 1
+            section["estimated_calls"] += entry["tokens_estimated"]
+            section["input_tokens"] += entry["input_tokens"]
+            section["output_tokens"] += entry["output_tokens"]
+            section["seconds"] = round(section["seconds"] + entry["seconds"], 3)
+        return stats
+
+    def _restore_iterations(self, section: str, context: str) -> list:
+        return self.checkpoints.restore(section, context) if self.checkpoints is not None else []
+
+    def _checkpoint_iteration(self, section: str, iteration: int, text: str, context: str):
+        if self.checkpoints is not None:
+            self.checkpoints.save(section, iteration, text, context)
+
+    def tree_paths(self, text: str) -> set:
+        # Root-to-node paths of (text, type) pairs, used to compare two rounds without allocating node IDs.
+        paths = set()
+        stack = []
+        for line in text.splitlines():
+            token = self.tokenize_line(line)
+            if token is None:
+                continue
+            indent, new_text, node_type, _ = token
+            while stack and indent <= stack[-1][1]:
+                stack.pop()
+            path = (stack[-1][0] if stack else ()) + ((new_text, node_type),)
+            paths.add(path)
+            stack.append((path, indent))
+        return paths
+
+    def has_converged(self, section: str, previous_text: str, text: str) -> bool:
+        if self.convergence_threshold is None or previous_text is None:
+            return False
+        with self.tracer.span("convergence", run=self.run_id, section=section) as span:
+            previous_paths = self.tree_paths(previous_text)
+            paths = self.tree_paths(text)
+            growth = (len(paths) - len(previous_paths)) / max(len(previous_paths), 1)
+            span["previous_paths"] = len(previous_paths)
+            span["paths"] = len(paths)
+            span["growth"] = round(growth, 4)
+            span["structural_change"] = round(len(paths ^ previous_paths) / max(len(paths | previous_paths), 1), 4)
+            span["converged"] = growth < self.convergence_threshold
+        return span["converged"]
+
+    def _skip_converged_round(self, section: str, iteration: int, text: str, context: str, stream_lit_bar):
+        # The unchanged text is checkpointed for the skipped round so saved rounds stay aligned with iterations.
+        self._checkpoint_iteration(section, iteration, text, context)
+        stream_lit_bar.progress(self._advance_step(),text=f"{section} iteration : {iteration+1} skipped, tree converged")
+
+    def build_messages(self, system_instruction: str, user_prompt: str) -> list:
+        from langchain.schema import SystemMessage, HumanMessage
+        return [SystemMessage(content=system_instruction), HumanMessage(content=user_prompt)]
+
+    def next_node_id(self) -> str:
+        with self._node_lock:
+            node_id = str(self.node_counter)
+            self.node_counter += 1
+            return node_id
 
     def generate_alias(self, base_text: str, node_type: str) -> str:
         # This function is kept for deduplication purposes only.
@@ -39,83 +395,86 @@ class CombinedMedicalTreeGenerator:
         cleaned = re.sub(r'\n{3,}', '\n\n', cleaned)
         return cleaned
 
-    def parse_indentation_tree(self, tree_str: str) -> list:
-        lines = tree_str.splitlines()
-        stack = []
-        nodes_list = []
+    def tokenize_line(self, line: str):
+        # Returns (indent, text, extracted node type or None, is_list_item), or None for blank lines.
+        original_line = line.strip()
+        if not original_line:
+            return None
+        indent = len(line) - len(line.lstrip(' '))
+        is_list_item = False
+        if original_line.startswith("- "):
+            is_list_item = True
+            original_line = original_line[2:].strip()
+        node_type_extracted = None
+        new_text = original_line
+        # The last "(...)" group without nested brackets opens at the last "(" before the last ")".
+        close_pos = original_line.rfind(')')
+        open_pos = original_line.rfind('(', 0, close_pos) if close_pos != -1 else -1
+        if open_pos != -1:
+            node_type_extracted = original_line[open_pos + 1:original_line.index(')', open_pos)].strip()
+            suffix = '(' + node_type_extracted + ')'
+            if original_line.endswith(suffix):
+                new_text = original_line[:-len(suffix)].rstrip()
+        if new_text.endswith(":"):
+            new_text = new_text[:-1].strip()
+        return indent, new_text, node_type_extracted, is_list_item
+
+    def iter_indentation_tree(self, lines):
+        # Yields each node as soon as its line is read; "childs" and "isLeaf" keep
+        # being updated on already-yielded nodes as their children arrive.
+        builder = IndentationTreeBuilder(self)
         for line in lines:
-            if not line.strip():
+            node = builder.add_line(line)
+            if node is not None:
+                yield node
+
+    def parse_indentation_tree(self, tree_str: str) -> list:
+        return list(self.iter_indentation_tree(tree_str.splitlines()))
+
+    def parse_indentation_store(self, tree_str: str) -> NodeStore:
+        # Same nodes and IDs as parse_indentation_tree, packed into a NodeStore as the lines are read.
+        builder = StoreTreeBuilder(self)
+        for line in tree_str.splitlines():
+            builder.add_line(line)
+        return builder.finish()
+
+    def node_digest(self, node: dict, child_digests) -> bytes:
+        # Fixed-size Merkle digest of the node's own fields plus its children's digests.
+        return merkle_digest(node["text"], node["nodeType"], node.get("parentText"), child_digests)
+
+    def compute_signatures(self, node_dict: dict) -> dict:
+        # Iterative post-order traversal, so deep trees cannot hit the recursion limit.
+        memo = {}
+        # Parsed lists are in pre-order, so walking them backwards usually finds every child
+        # already digested; the explicit stack only handles the remaining cases.
+        for start_id in reversed(node_dict):
+            if start_id in memo:
                 continue
-            indent = len(line) - len(line.lstrip(' '))
-            original_line = line.strip()
-            is_list_item = False
-            if original_line.startswith("- "):
-                is_list_item = True
-                original_line = original_line[2:].strip()
-            bracket_matches = re.findall(r'\(([^()]*)\)', original_line)
-            node_type_extracted = None
-            if bracket_matches:
-                node_type_extracted = bracket_matches[-1].strip()
-                new_text = re.sub(r'\s*\(' + re.escape(node_type_extracted) + r'\)\s*$', '', original_line)
-            else:
-                new_text = original_line
-            if new_text.endswith(":"):
-                new_text = new_text[:-1].strip()
-            if node_type_extracted is not None:
-                node_type = node_type_extracted
-            else:
-                if not stack:
-                    node_type = "root"
+            node = node_dict[start_id]
+            child_digests = [memo.get(child_id) for child_id in node["childs"]]
+            if None not in child_digests:
+                memo[start_id] = self.node_digest(node, child_digests)
+                continue
+            stack = [(start_id, False)]
+            while stack:
+                node_id, children_done = stack.pop()
+                if node_id in memo:
+                    continue
+                node = node_dict[node_id]
+                if children_done:
+                    memo[node_id] = self.node_digest(node, (memo[child_id] for child_id in node["childs"]))
                 else:
-                    if new_text.endswith('?'):
-                        node_type = "question"
-                    elif is_list_item:
-                        node_type = "option"
-                    else:
-                        node_type = "node"
-            while stack and indent <= stack[-1][1]:
-                stack.pop()
-            if stack:
-                parent_node, _ = stack[-1]
-                parent_id = parent_node["id"]
-                parent_text = parent_node["text"]
-            else:
-                parent_id = None
-                parent_text = None
-            node_id = str(self.node_counter)
-            self.node_counter += 1
-            node = {
-                "id": node_id,
-                "nodeType": node_type,
-                "text": new_text,
-                "isLeaf": True,
-                "parent": parent_id,
-                "parentText": parent_text,
-                "childs": []
-            }
-            nodes_list.append(node)
-            if parent_id:
-                parent_node["childs"].append(node_id)
-                parent_node["isLeaf"] = False
-            stack.append((node, indent))
-        return nodes_list
+                    stack.append((node_id, True))
+                    stack.extend((child_id, False) for child_id in reversed(node["childs"]) if child_id not in memo)
+        return memo
 
     def deduplicate_nodes(self, nodes_list: list) -> tuple:
         node_dict = {node["id"]: node for node in nodes_list}
-        memo = {}
+        signatures = self.compute_signatures(node_dict)
         signature_map = {}
         alias_mapping = {}
-        def get_signature(node_id):
-            if node_id in memo:
-                return memo[node_id]
-            node = node_dict[node_id]
-            child_signatures = tuple(get_signature(child_id) for child_id in node["childs"])
-            parent_text = node.get("parentText")
-            signature = (node["text"], node["nodeType"], parent_text, child_signatures)
-            memo[node_id] = signature
-            return signature
         for node_id in node_dict:
-            sig = get_signature(node_id)
+            sig = signatures[node_id]
             if sig not in signature_map:
                 signature_map[sig] = node_id
             alias_mapping[node_id] = signature_map[sig]
@@ -156,39 +515,53 @@ class CombinedMedicalTreeGenerator:
             transformed[node_id] = new_node
         return transformed
 
+    def total_steps(self) -> int:
+        return self.indication_iterations + self.technical_iterations + self.result_iterations
+
+    def _advance_step(self) -> float:
+        with self._step_lock:
+            self.current_step += 1
+            return self.current_step / self.total_steps()
+
     def get_node_color(self, node_type: str) -> str:
-        color_map = {
-            'TYPE_TITLE': 'darkblue',
-            'TYPE_TOPIC': 'orange',
-            'TYPE_QUESTION': 'lightblue',
-            'TYPE_QCM': 'lightgreen',
-            'TYPE_QCS': 'lightpink',
-            'TYPE_MEASURE': 'yellow',
-            'TYPE_DATE': 'violet',
-            'TYPE_TEXT': 'tan',
-            'TYPE_OPERATION': 'cyan',
-            'TYPE_CALCULATION': 'magenta',
-            'TYPE_ROOT': 'red'
-        }
-        return color_map.get(node_type, 'gray')
-
-    def plot_tree(self, nodes, output_filename):
-        dot = Digraph(comment='Combined Medical Tree')
-        for node_id, node in nodes.items():
-            label = node.get('text', node_id)
-            fillcolor = self.get_node_color(node.get('nodeType', ''))
-            dot.node(node_id, label=label, style='filled', fillcolor=fillcolor)
-        for parent_id, node in nodes.items():
-            for child in node.get('childs', []):
-                if child["id"] in nodes:
-                    dot.edge(parent_id, child["id"])
-        dot.format = 'png'
-        output_path = dot.render(output_filename, view=False)
+        return tree_render.node_color(node_type)
+
+    def export_tree(self, nodes, path, fmt=None) -> int:
+        # Streams the node list returned by run() to NDJSON or msgpack (chosen by extension) for a later publish.
+        with self.tracer.span("export", run=self.run_id, path=path, nodes=len(nodes)) as span:
+            span["bytes"] = tree_export.save_tree(nodes, path, fmt)
+        return span["bytes"]
+
+    @staticmethod
+    def import_tree(path, fmt=None) -> list:
+        return tree_export.load_tree(path, fmt)
+
+    def plot_tree(self, nodes, output_filename, fmt='png', section=None, max_depth=None, renderer=None):
+        # section picks INDICATION/TECHNICAL/RESULT and max_depth folds deeper levels; use
+        # TreeRenderer.submit directly to render without blocking.
+        renderer = renderer or tree_render.TreeRenderer(tracer=self.tracer)
+        output_path = renderer.render(nodes, output_filename, fmt, section=section, max_depth=max_depth)
         print(f"Combined tree plot saved as: {output_path}")
+        return output_path
 
     def generate_indication_tree(self,stream_lit_bar) -> str:
+        return run_sync(self.agenerate_indication_tree(stream_lit_bar))
+
+    async def agenerate_indication_tree(self,stream_lit_bar) -> str:
         expanded_prompt = None
+        converged = False
+        self.rounds_used["INDICATION"] = 0
+        restored = self._restore_iterations("INDICATION", self.checkpoint_context)
         for iteration in range(self.indication_iterations):
+            if iteration < len(restored):
+                expanded_prompt = restored[iteration]
+                self.rounds_used["INDICATION"] += 1
+                stream_lit_bar.progress(self._advance_step(),text=f"INDICATION iteration : {iteration+1} restored from checkpoint")
+                continue
+            if converged and iteration < self.indication_iterations - 1:
+                self._skip_converged_round("INDICATION", iteration, expanded_prompt, self.checkpoint_context, stream_lit_bar)
+                continue
+            previous_prompt = expanded_prompt
             system_instruction = f"""
 **goal:**
 You are a medical professional. Your task is to generate a structured, hierarchical INDICATION tree for a radiological exam. The tree should clearly document the clinical rationale by including patient details (such as age, sex, and history), the main symptoms prompting the exam, and disease-specific diagnostic questions. This output must be strictly tailored to the file type "{self.file_type}" and the following diseases: {', '.join(self.disease_context)}.
@@ -279,7 +652,7 @@ Focus on listing the major high-level categories and nodes with minimal sub-leve
             elif iteration == self.indication_iterations - 1:
                 user_prompt = f"""
 **goal:**
-Refine and fully complete the provided INDICATION section {expanded_prompt} by adding deeper sub-questions to nodes that are still underdeveloped or incomplete. Ensure that every clinically relevant question is addressed and no node remains partially expanded. Focus particularly on expanding disease-specific and symptom-related branches until every clinically relevant question is exhausted.
+Refine and fully complete the provided INDICATION section {self._previous_tree('INDICATION', expanded_prompt)} by adding deeper sub-questions to nodes that are still underdeveloped or incomplete. Ensure that every clinically relevant question is addressed and no node remains partially expanded. Focus particularly on expanding disease-specific and symptom-related branches until every clinically relevant question is exhausted.
 
 **return format:**
 - Retain the single top-level "INDICATION:" node with all further details indented at 4 spaces per level.
@@ -299,7 +672,7 @@ Refine and fully complete the provided INDICATION section {expanded_prompt} by a
             else:
                 user_prompt = f"""
 **goal:**
-Refine and expand the existing INDICATION section {expanded_prompt} by increasing the depth of the tree. Add deeper sub-questions and details for disease-specific and symptom-related branches, but do not finalize all nodes. This iteration aims to progressively elaborate the content without completing every branch fully.
+Refine and expand the existing INDICATION section {self._previous_tree('INDICATION', expanded_prompt)} by increasing the depth of the tree. Add deeper sub-questions and details for disease-specific and symptom-related branches, but do not finalize all nodes. This iteration aims to progressively elaborate the content without completing every branch fully.
 
 **return format:**
 - Keep the single top-level "INDICATION:" node with subsequent nodes indented at 4 spaces per level.
@@ -314,17 +687,29 @@ Refine and expand the existing INDICATION section {expanded_prompt} by increasin
 - The INDICATION tree is designed for a radiological exam specifically related to "{self.file_type}" and the diseases: {', '.join(self.disease_context)}.
 - This iteration focuses on progressively refining the tree, adding sub-level detail where necessary while leaving room for final completion in later iterations.
 """
-            messages = [SystemMessage(content=system_instruction), HumanMessage(content=user_prompt)]
-            response = self.model.invoke(messages)
-            expanded_prompt = self.extract_section(response.content)
-            self.current_step+=1
-            stream_lit_bar.progress(self.current_step/(self.indication_iterations+self.technical_iterations+self.result_iterations),text=f"INDICATION iteration : {iteration+1} completed")
+            if iteration > 0:
+                user_prompt += self._compact_instructions("INDICATION")
+            messages = self.build_messages(system_instruction, user_prompt)
+            expanded_prompt = await self._refine(messages, "INDICATION", iteration, self.indication_iterations, previous_prompt, stream_lit_bar)
+            self._checkpoint_iteration("INDICATION", iteration, expanded_prompt, self.checkpoint_context)
+            self.rounds_used["INDICATION"] += 1
+            if iteration < self.indication_iterations - 1:
+                converged = self.has_converged("INDICATION", previous_prompt, expanded_prompt)
+            stream_lit_bar.progress(self._advance_step(),text=f"INDICATION iteration : {iteration+1} completed")
         print(f"Length of INDICATION tree text: {len(expanded_prompt)}")
         return expanded_prompt
 
     def generate_technical_tree(self,stream_lit_bar) -> str:
+        return run_sync(self.agenerate_technical_tree(stream_lit_bar))
+
+    async def agenerate_technical_tree(self,stream_lit_bar) -> str:
         technical_tree = None
+        restored = self._restore_iterations("TECHNIQUE", self.checkpoint_context)
         for iteration in range(self.technical_iterations):
+            if iteration < len(restored):
+                technical_tree = restored[iteration]
+                stream_lit_bar.progress(self._advance_step(),text=f"TECHNIQUE iteration : {iteration+1} restored from checkpoint")
+                continue
             system_instruction = f"""
 **goal:**
 You are a medical professional. Your goal is to generate a structured, hierarchical TECHNICAL tree for a radiological exam. This tree should detail the technical parameters and protocols used during imaging—such as the use of contrast injections, imaging sequences (e.g., T1, T2, FLAIR, angiographic sequences), and other modality-specific settings. This output must be strictly tailored to the file type "{self.file_type}" and the following diseases: {', '.join(self.disease_context)}. The TECHNICAL tree will typically follow the INDICATION tree {{expanded_prompt}} for context, but it should not duplicate information from the INDICATION or RESULT trees.
@@ -399,17 +784,37 @@ Generate a single structured and deep TECHNICAL section for a radiological exam
 - The TECHNICAL tree references the specific imaging protocols after the INDICATION tree, so it should logically reflect the sequences and parameters necessary for the file type "{self.file_type}" and diseases: {', '.join(self.disease_context)}.
 - This prompt requires a comprehensive but not overly complex structure, ensuring major parameters (e.g., contrast usage, sequence list, coil or scanning parameters) are included without redundancy.
 """
-            messages = [SystemMessage(content=system_instruction), HumanMessage(content=user_prompt)]
-            response = self.model.invoke(messages)
-            technical_tree = self.extract_section(response.content)
-            self.current_step+=1
-            stream_lit_bar.progress(self.current_step/(self.indication_iterations+self.technical_iterations+self.result_iterations),text=f"TECHNIQUE iteration : {iteration+1} completed")
+            messages = self.build_messages(system_instruction, user_prompt)
+            technical_tree = self.extract_section(await self._invoke_round(messages, "TECHNIQUE", iteration, self.technical_iterations, stream_lit_bar))
+            self._checkpoint_iteration("TECHNIQUE", iteration, technical_tree, self.checkpoint_context)
+            stream_lit_bar.progress(self._advance_step(),text=f"TECHNIQUE iteration : {iteration+1} completed")
         print(f"Length of TECHNICAL tree text: {len(technical_tree)}")
         return technical_tree
 
     def generate_result_tree(self, indication_tree_text: str, technical_tree_text: str,stream_lit_bar) -> str:
+        return run_sync(self.agenerate_result_tree(indication_tree_text, technical_tree_text, stream_lit_bar))
+
+    async def agenerate_result_tree(self, indication_tree_text: str, technical_tree_text: str,stream_lit_bar) -> str:
         result = None
+        # RESULT rounds embed the other two trees, so their checkpoints are only valid for the same inputs.
+        context = fingerprint(self.checkpoint_context, indication_tree_text, technical_tree_text)
+        converged = False
+        self.rounds_used["RESULT"] = 0
+        restored = self._restore_iterations("RESULT", context)
+        if self.compactor is not None:
+            # The other two trees are only context here, so a depth-limited outline of each is enough.
+            indication_tree_text = self.compactor.context_outline(indication_tree_text)
+            technical_tree_text = self.compactor.context_outline(technical_tree_text)
         for iteration in range(self.result_iterations):
+            if iteration < len(restored):
+                result = restored[iteration]
+                self.rounds_used["RESULT"] += 1
+                stream_lit_bar.progress(self._advance_step(),text=f"RESULT iteration : {iteration+1} restored from checkpoint")
+                continue
+            if converged and iteration < self.result_iterations - 1:
+                self._skip_converged_round("RESULT", iteration, result, context, stream_lit_bar)
+                continue
+            previous_result = result
             if iteration == 0:
                 user_prompt = f"""
 **goal:**
@@ -420,7 +825,7 @@ List major anatomical categories (e.g., pleura, parenchyma, mediastinum, bones,
             elif iteration == self.result_iterations - 1:
                 user_prompt = f"""
 **goal:**
-Refine and fully complete the provided RESULT section {result} by adding deeper sub-questions or nodes for each anatomical category. Focus on detailing any abnormalities (e.g., describing size, extent, severity, specific locations) and including measurement, logical, or calculation nodes as necessary. Ensure that every node is properly generated without any cut-offs.
+Refine and fully complete the provided RESULT section {self._previous_tree('RESULT', result)} by adding deeper sub-questions or nodes for each anatomical category. Focus on detailing any abnormalities (e.g., describing size, extent, severity, specific locations) and including measurement, logical, or calculation nodes as necessary. Ensure that every node is properly generated without any cut-offs.
 
 **return format:**
 - Retain the single top-level "RESULT:" node with all further details indented at 4 spaces per level.
@@ -430,7 +835,7 @@ Refine and fully complete the provided RESULT section {result} by adding deeper
             else:
                 user_prompt = f"""
 **goal:**
-Refine and expand the existing RESULT section {result} by adding deeper sub-questions and details where clinically appropriate. Emphasize further elaboration of abnormal findings while maintaining the overall structure.
+Refine and expand the existing RESULT section {self._previous_tree('RESULT', result)} by adding deeper sub-questions and details where clinically appropriate. Emphasize further elaboration of abnormal findings while maintaining the overall structure.
 
 **return format:**
 - Maintain a single top-level "RESULT:" node with subsequent nodes indented at 4 spaces per level.
@@ -525,14 +930,116 @@ RESULT: (TYPE_TITLE)
 - Nodes can represent normal or abnormal findings, sub-classifications of abnormalities, measurement details, or additional descriptive text where clinically relevant.
 - This structure is designed to accommodate detailed reporting of radiological findings, ensuring clarity and consistency in how results are documented.
 """
-            messages = [SystemMessage(content=system_instruction), HumanMessage(content=user_prompt)]
-            response = self.model.invoke(messages)
-            result = self.extract_section(response.content)
-            self.current_step+=1
-            stream_lit_bar.progress(self.current_step/(self.indication_iterations+self.technical_iterations+self.result_iterations),text=f"RESULT iteration : {iteration+1} completed")
+            root_lines, branches = self.split_branches(result) if self.result_fanout and result is not None else ([], [])
+            if branches:
+                result = await self.aexpand_result_branches(system_instruction, root_lines, branches, iteration, stream_lit_bar)
+            else:
+                if iteration > 0:
+                    user_prompt += self._compact_instructions("RESULT")
+                messages = self.build_messages(system_instruction, user_prompt)
+                result = await self._refine(messages, "RESULT", iteration, self.result_iterations, previous_result, stream_lit_bar)
+            self._checkpoint_iteration("RESULT", iteration, result, context)
+            self.rounds_used["RESULT"] += 1
+            if iteration < self.result_iterations - 1:
+                converged = self.has_converged("RESULT", previous_result, result)
+            stream_lit_bar.progress(self._advance_step(),text=f"RESULT iteration : {iteration+1} completed")
         print(f"Length of RESULT tree text: {len(result)}")
         return result
 
+    def split_branches(self, text: str) -> tuple:
+        # Splits a section into its root lines and one block of lines per top-level branch, using the
+        # same tokenizer as parse_indentation_tree so that no node IDs are consumed.
+        root_lines = []
+        branches = []
+        root_indent = None
+        branch_indent = None
+        for line in text.splitlines():
+            token = self.tokenize_line(line)
+            if token is None:
+                continue
+            indent = token[0]
+            if root_indent is None:
+                root_indent = indent
+                root_lines.append(line)
+            elif branch_indent is None or indent <= branch_indent:
+                if branch_indent is None:
+                    branch_indent = indent
+                branches.append([line])
+            else:
+                branches[-1].append(line)
+        return root_lines, branches
+
+    def graft_branch(self, branch_lines: list, expanded_text: str, root_text: str) -> list:
+        # Re-indents an expanded branch so that it sits where the original branch did.
+        lines = [line.replace("\t", "    ") for line in expanded_text.splitlines() if line.strip()]
+        first = self.tokenize_line(lines[0]) if lines else None
+        if first is not None and first[1] == root_text and len(lines) > 1:
+            # The model repeated the section root above the branch.
+            lines = lines[1:]
+        if not lines:
+            return branch_lines
+        base_indent = min(len(line) - len(line.lstrip(" ")) for line in lines)
+        target_indent = len(branch_lines[0]) - len(branch_lines[0].lstrip(" "))
+        return [" " * (target_indent + len(line) - len(line.lstrip(" ")) - base_indent) + line.strip() for line in lines]
+
+    def branch_prompt(self, branch_text: str, sibling_names: list, iteration: int) -> str:
+        branch_name = self.tokenize_line(branch_text.splitlines()[0])[1]
+        if iteration == self.result_iterations - 1:
+            goal = f"Refine and fully complete the \"{branch_name}\" branch of the RESULT section {self._previous_tree('RESULT', branch_text)} by adding deeper sub-questions or nodes. Focus on detailing any abnormalities (e.g., describing size, extent, severity, specific locations) and including measurement, logical, or calculation nodes as necessary. Ensure that every node is properly generated without any cut-offs."
+        else:
+            goal = f"Refine and expand the \"{branch_name}\" branch of the RESULT section {self._previous_tree('RESULT', branch_text)} by adding deeper sub-questions and details where clinically appropriate. Emphasize further elaboration of abnormal findings while maintaining the overall structure."
+        return f"""
+**goal:**
+{goal}
+
+**return format:**
+- Return only this branch: "{branch_name}" must be the single top-level line, with zero indentation, and every further node indented at 4 spaces per level.
+- All nodes must include their label followed by the nodetype in parentheses.
+
+**warnings:**
+- The other RESULT branches are expanded separately; do not add them here: {', '.join(sibling_names)}.
+"""
+
+    def branch_signature(self, branch_lines: list, iteration: int) -> str:
+        # Same normalisation as deduplication (generate_alias) and relative indentation. The model and the prompt
+        # mode are always part of the key; the exam and the diseases only when branches are not shared.
+        tokens = [token for token in map(self.tokenize_line, branch_lines) if token is not None]
+        base_indent = min((token[0] for token in tokens), default=0)
+        outline = [(token[0] - base_indent, self.generate_alias(token[1], token[2] or ""), token[2] or "") for token in tokens]
+        scope = fingerprint(self.model_name, self.temperature) if self.share_branches else self.checkpoint_context
+        return signature_key(KIND_BRANCH, "RESULT", scope, self.share_branches, self.compactor is not None,
+                             iteration, self.result_iterations, outline)
+
+    def expand_result_branches(self, system_instruction: str, root_lines: list, branches: list, iteration: int, stream_lit_bar) -> str:
+        return run_sync(self.aexpand_result_branches(system_instruction, root_lines, branches, iteration, stream_lit_bar))
+
+    async def aexpand_result_branches(self, system_instruction: str, root_lines: list, branches: list, iteration: int, stream_lit_bar) -> str:
+        root_text = self.tokenize_line(root_lines[0])[1]
+        names = [self.tokenize_line(branch[0])[1] for branch in branches]
+        slots = asyncio.Semaphore(self.branch_workers)
+
+        async def expand(index):
+            branch_text = "\n".join(branches[index])
+            if self.subtree_library is not None:
+                key = self.branch_signature(branches[index], iteration)
+                known = self.subtree_library.get(KIND_BRANCH, key)
+                if known is not None:
+                    self.subtree_library.saved(KIND_BRANCH, len(known.encode("utf-8")))
+                    return self.graft_branch(branches[index], known, root_text)
+            user_prompt = self.branch_prompt(branch_text, names[:index] + names[index + 1:], iteration)
+            if self.compactor is not None:
+                user_prompt += self._compact_instructions(names[index])
+            messages = self.build_messages(system_instruction, user_prompt)
+            async with slots:
+                expanded = await self._refine(messages, "RESULT", iteration, self.result_iterations, branch_text, stream_lit_bar, stream=False)
+            if self.subtree_library is not None and expanded.strip():
+                self.subtree_library.put(KIND_BRANCH, key, expanded)
+            return self.graft_branch(branches[index], expanded, root_text)
+
+        stream_lit_bar.progress(self.current_step/self.total_steps(),text=f"RESULT iteration : {iteration+1} expanding {len(branches)} branches")
+        expanded_branches = await gather_or_cancel(*(expand(index) for index in range(len(branches))))
+        return "\n".join(root_lines + [line for branch in expanded_branches for line in branch])
+
     def combine_trees(self, indication_nodes: list, technical_nodes: list, result_nodes: list) -> dict:
         def get_root(nodes):
             for node in nodes:
@@ -543,8 +1050,7 @@ RESULT: (TYPE_TITLE)
         indication_root = get_root(indication_nodes)
         technical_root = get_root(technical_nodes)
         result_root = get_root(result_nodes)
-        new_root_id = str(self.node_counter)
-        self.node_counter += 1
+        new_root_id = self.next_node_id()
         new_root = {
             "id": new_root_id,
             "nodeType": "TYPE_ROOT",
@@ -570,39 +1076,88 @@ RESULT: (TYPE_TITLE)
         dedup_nodes, _ = self.deduplicate_nodes(combined_nodes)
         return dedup_nodes
 
-    def run(self,stream_lit_bar,stream_lit_text):
+    def generate_indication_and_technical(self, stream_lit_bar, stream_lit_text) -> tuple:
+        return run_sync(self.agenerate_indication_and_technical(stream_lit_bar, stream_lit_text))
+
+    async def agenerate_indication_and_technical(self, stream_lit_bar, stream_lit_text) -> tuple:
+        # The TECHNICAL prompt does not depend on the INDICATION text, so both chains run side by side;
+        # if one fails or times out the other is cancelled.
+        stream_lit_text.text("Generating INDICATION and TECHNICAL trees...")
+        stream_lit_bar.progress(self.current_step/self.total_steps(),"Starting Indication and Technical tree generation")
+        indication_text, technical_text = await gather_or_cancel(
+            self._stage("INDICATION", self.agenerate_indication_tree(stream_lit_bar)),
+            self._stage("TECHNIQUE", self.agenerate_technical_tree(stream_lit_bar)))
+        return indication_text, technical_text
+
+    def assemble_tree(self, indication_text: str, technical_text: str, result_text: str) -> list:
+        stores = []
+        for section, section_text in (("INDICATION", indication_text), ("TECHNIQUE", technical_text), ("RESULT", result_text)):
+            with self.tracer.span("parse", run=self.run_id, section=section, streamed=section in self.streamed_stores) as span:
+                store = self.streamed_stores.get(section) or self.parse_indentation_store(section_text)
+                stores.append(store)
+                span["nodes"] = len(store)
+        # Each section is deduplicated once; NodeStore.fuse then combines, deduplicates and transforms in one pass.
+        sections = []
+        for section, store in zip(("INDICATION", "TECHNIQUE", "RESULT"), stores):
+            with self.tracer.span("dedup", run=self.run_id, section=section) as span:
+                sections.append(store.section_digests(self.file_type))
+                span["nodes"] = len(sections[-1][0])
+        indication_count, technical_count, result_count = (len(section[0]) for section in sections)
+        print(f"length of indication tree :{indication_count}")
+        print(f"length of technical tree :{technical_count}")
+        print(f"length of result tree :{result_count}")
+        print(f"sum: {indication_count+technical_count+result_count}")
+        new_root_id = self.next_node_id()
+        with self.tracer.span("fuse", run=self.run_id) as span:
+            transformed_nodes = NodeStore.fuse(int(new_root_id), "TYPE_ROOT", self.file_type, stores, sections)
+            span["nodes"] = len(transformed_nodes)
+        print(f"Length of combined tree: {len(transformed_nodes)}")
+        return transformed_nodes
+
+    def run(self,stream_lit_bar=None,stream_lit_text=None):
+        return run_sync(self.arun(stream_lit_bar, stream_lit_text))
+
+    async def _stage(self, name: str, awaitable):
+        return await with_timeout(awaitable, self.stage_timeouts.get(name), name)
+
+    async def arun(self,stream_lit_bar=None,stream_lit_text=None):
+        # Without Streamlit elements progress updates are dropped.
+        stream_lit_bar = stream_lit_bar if stream_lit_bar is not None else NullProgress()
+        stream_lit_text = stream_lit_text if stream_lit_text is not None else NullProgress()
+        started = time.perf_counter()
+        self.run_id = uuid.uuid4().hex[:12]
         self.current_step = 0
-        stream_lit_text.text("Generating INDICATION tree...")
-        stream_lit_bar.progress(self.current_step/(self.indication_iterations+self.technical_iterations+self.result_iterations),"Starting Indication tree generation")
-        indication_text = self.generate_indication_tree(stream_lit_bar=stream_lit_bar)
-        stream_lit_text.text("Successfully generated INDICATION tree. Generating TECHNICAL tree...")
-        stream_lit_bar.progress(self.current_step/(self.indication_iterations+self.technical_iterations+self.result_iterations),"Starting Technical tree generation")
-        technical_text = self.generate_technical_tree(stream_lit_bar=stream_lit_bar)
-        stream_lit_text.text("Successfully generated TECHNIQUE tree. Generating RESULT tree...")
-        stream_lit_bar.progress(self.current_step/(self.indication_iterations+self.technical_iterations+self.result_iterations),"Starting Result tree generation")
-        result_text = self.generate_result_tree(indication_text, technical_text,stream_lit_bar=stream_lit_bar)
-        indication_nodes = self.parse_indentation_tree(indication_text)
-        technical_nodes = self.parse_indentation_tree(technical_text)
-        result_nodes = self.parse_indentation_tree(result_text)
-
-        indication_dedup, _ = self.deduplicate_nodes(indication_nodes)
-        technical_dedup, _ = self.deduplicate_nodes(technical_nodes)
-        result_dedup, _ = self.deduplicate_nodes(result_nodes)
-        print(f"length of indication tree :{len(indication_dedup)}")
-        print(f"length of technical tree :{len(technical_dedup)}")
-        print(f"length of result tree :{len(result_dedup)}")
-        print(f"sum: {len(indication_dedup)+len(technical_dedup)+len(result_dedup)}")
-        combined_nodes = self.combine_trees(list(indication_dedup.values()),
-                                            list(technical_dedup.values()),
-                                            list(result_dedup.values()))
-        print(f"Length of combined tree: {len(combined_nodes)}")
-        transformed_nodes = self.transform_nodes(combined_nodes)
+        self.streamed_stores = {}
+        self.round_stats = []
+        if self.parallel:
+            indication_text, technical_text = await self.agenerate_indication_and_technical(stream_lit_bar, stream_lit_text)
+            stream_lit_text.text("Successfully generated INDICATION and TECHNIQUE trees. Generating RESULT tree...")
+        else:
+            stream_lit_text.text("Generating INDICATION tree...")
+            stream_lit_bar.progress(self.current_step/self.total_steps(),"Starting Indication tree generation")
+            indication_text = await self._stage("INDICATION", self.agenerate_indication_tree(stream_lit_bar=stream_lit_bar))
+            stream_lit_text.text("Successfully generated INDICATION tree. Generating TECHNICAL tree...")
+            stream_lit_bar.progress(self.current_step/self.total_steps(),"Starting Technical tree generation")
+            technical_text = await self._stage("TECHNIQUE", self.agenerate_technical_tree(stream_lit_bar=stream_lit_bar))
+            stream_lit_text.text("Successfully generated TECHNIQUE tree. Generating RESULT tree...")
+        stream_lit_bar.progress(self.current_step/self.total_steps(),"Starting Result tree generation")
+        result_text = await self._stage("RESULT", self.agenerate_result_tree(indication_text, technical_text,stream_lit_bar=stream_lit_bar))
+        # Parsing and fusing are CPU-bound, so they run off the event loop.
+        transformed_nodes = await asyncio.to_thread(self.assemble_tree, indication_text, technical_text, result_text)
+        if self.checkpoints is not None:
+            self.checkpoints.clear()
         stream_lit_text.text("Successfully generated and processed tree")
+        logger.info("Refinement rounds used: %s", self.rounds_used)
+        logger.info("Prompt tokens per section: %s", self.prompt_stats())
+        if self.subtree_library is not None:
+            logger.info("Subtree library stats: %s", self.subtree_library.stats())
+        self.tracer.record("generate", time.perf_counter() - started, run=self.run_id, file_type=self.file_type,
+                           nodes=len(transformed_nodes))
         print(f"Returning the tree")
-        return list(transformed_nodes.values())
+        return transformed_nodes
                     
         # with open(self.combined_json_filename, "w") as f:
-        #     json.dump(list(transformed_nodes.values()), f, indent=2)
+        #     json.dump(transformed_nodes, f, indent=2)
         # print(f"Combined JSON saved to {self.combined_json_filename}")
 
         # # self.plot_tree(transformed_nodes, self.combined_png_filename)
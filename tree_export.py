@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+
+FORMAT_NAME = "doctreen-nodes"
+FORMAT_VERSION = 1
+EXTENSIONS = {".ndjson": "ndjson", ".jsonl": "ndjson", ".msgpack": "msgpack", ".mpk": "msgpack", ".json": "json"}
+
+# Both streaming formats share one record layout. A bare string introduces the next entry of the string table,
+# so every type and text is written once; a node is the list
+#   [id, type, text, isLeaf, parent, childs]
+# where type and text index the string table, parent is null or [id, text] and childs is a flat
+# [id, text, id, text, ...] list. Numeric node IDs are stored as integers.
+
+
+def encode_id(node_id):
+    if isinstance(node_id, str) and node_id.isdigit() and str(int(node_id)) == node_id:
+        return int(node_id)
+    return node_id
+
+
+def decode_id(node_id):
+    return str(node_id) if isinstance(node_id, int) else node_id
+
+
+def encode_nodes(nodes):
+    # Yields the header, then string table entries and node records in stream order.
+    yield {"format": FORMAT_NAME, "version": FORMAT_VERSION}
+    table = {}
+
+    def intern(value):
+        index = table.get(value)
+        if index is None:
+            index = table[value] = len(table)
+            pending.append(value)
+        return index
+
+    for node in nodes:
+        pending = []
+        parent = node.get("parent")
+        childs = []
+        for child in node.get("childs") or ():
+            childs.append(encode_id(child["id"]))
+            childs.append(intern(child["text"]))
+        record = [encode_id(node["id"]), intern(node.get("nodeType", "")), intern(node["text"]), int(bool(node.get("isLeaf"))),
+                  None if parent is None else [encode_id(parent["id"]), intern(parent["text"])], childs]
+        yield from pending
+        yield record
+
+
+def decode_nodes(items):
+    # Inverse of encode_nodes. Equal strings, IDs and {"id", "text"} references come back as one shared object,
+    # so the parent reference of siblings is a single dict; callers must treat the nodes as read-only.
+    items = iter(items)
+    header = next(items, None)
+    if not isinstance(header, dict) or header.get("format") != FORMAT_NAME:
+        raise ValueError("not a doctreen node stream")
+    if header.get("version") != FORMAT_VERSION:
+        raise ValueError(f"unsupported node stream version {header.get('version')}")
+    strings = []
+    ids = {}
+    references = {}
+
+    def node_id(value):
+        decoded = ids.get(value)
+        if decoded is None:
+            decoded = ids[value] = decode_id(value)
+        return decoded
+
+    def reference(value, text):
+        shared = references.get((value, text))
+        if shared is None:
+            shared = references[(value, text)] = {"id": node_id(value), "text": strings[text]}
+        return shared
+
+    for item in items:
+        if isinstance(item, str):
+            strings.append(item)
+            continue
+        ident, node_type, text, is_leaf, parent, childs = item
+        pairs = iter(childs)
+        yield {
+            "id": node_id(ident),
+            "nodeType": strings[node_type],
+            "text": strings[text],
+            "isLeaf": bool(is_leaf),
+            "parent": None if parent is None else reference(parent[0], parent[1]),
+            "childs": [reference(child, child_text) for child, child_text in zip(pairs, pairs)]
+        }
+
+
+def msgpack_module():
+    try:
+        import msgpack
+    except ImportError:
+        raise ImportError("the msgpack format needs the msgpack package (pip install msgpack)") from None
+    return msgpack
+
+
+def write_ndjson(nodes, f):
+    for item in encode_nodes(nodes):
+        f.write(json.dumps(item, ensure_ascii=False, separators=(",", ":")))
+        f.write("\n")
+
+
+def read_ndjson(f, chunk_lines=1024):
+    # Lines are parsed a chunk at a time as one JSON array, which is much cheaper than one json.loads per line.
+    def items():
+        chunk = []
+        for line in f:
+            if line.strip():
+                chunk.append(line)
+            if len(chunk) >= chunk_lines:
+                yield from json.loads("[" + ",".join(chunk) + "]")
+                chunk = []
+        if chunk:
+            yield from json.loads("[" + ",".join(chunk) + "]")
+
+    yield from decode_nodes(items())
+
+
+def write_msgpack(nodes, f):
+    packer = msgpack_module().Packer()
+    for item in encode_nodes(nodes):
+        f.write(packer.pack(item))
+
+
+def read_msgpack(f):
+    yield from decode_nodes(msgpack_module().Unpacker(f, raw=False, use_list=False))
+
+
+def detect_format(path: str) -> str:
+    # The extension decides; otherwise the first byte tells a JSON list, a JSON lines stream or a msgpack map apart.
+    extension = os.path.splitext(path)[1].lower()
+    if extension in EXTENSIONS:
+        return EXTENSIONS[extension]
+    with open(path, "rb") as f:
+        first = f.read(1)
+    if first == b"[":
+        return "json"
+    if first == b"{":
+        return "ndjson"
+    return "msgpack"
+
+
+def save_tree(nodes, path: str, fmt: str = None) -> int:
+    # Streams nodes (any iterable) to path through a temporary file; returns the file size in bytes.
+    fmt = fmt or EXTENSIONS.get(os.path.splitext(path)[1].lower(), "ndjson")
+    tmp_path = path + ".tmp"
+    if fmt == "json":
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(list(nodes), f)
+    elif fmt == "ndjson":
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            write_ndjson(nodes, f)
+    elif fmt == "msgpack":
+        with open(tmp_path, "wb") as f:
+            write_msgpack(nodes, f)
+    else:
+        raise ValueError(f"unknown tree format {fmt!r}")
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def iter_tree(path: str, fmt: str = None):
+    fmt = fmt or detect_format(path)
+    if fmt == "json":
+        with open(path, encoding="utf-8") as f:
+            yield from json.load(f)
+    elif fmt == "ndjson":
+        with open(path, encoding="utf-8") as f:
+            yield from read_ndjson(f)
+    elif fmt == "msgpack":
+        with open(path, "rb") as f:
+            yield from read_msgpack(f)
+    else:
+        raise ValueError(f"unknown tree format {fmt!r}")
+
+
+def load_tree(path: str, fmt: str = None) -> list:
+    return list(iter_tree(path, fmt))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert exported trees between formats or publish one to MongoDB.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert = commands.add_parser("convert", help="rewrite a tree file in another format")
+    convert.add_argument("source")
+    convert.add_argument("target", help="output file; .ndjson, .msgpack or .json")
+    publish = commands.add_parser("publish", help="publish an exported tree without regenerating it")
+    publish.add_argument("source")
+    publish.add_argument("--tree-name", required=True)
+    publish.add_argument("--owner-id", default=None)
+    publish.add_argument("--update-tree-id", default=None, help="update this stored tree instead of creating a new one")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        size = save_tree(iter_tree(args.source), args.target)
+        print(f"{args.source} ({os.path.getsize(args.source)} bytes) -> {args.target} ({size} bytes)")
+        return
+    from custom2doctreen_parser import CustomToDoctreenConverter
+    from batch_runner import DEFAULT_OWNER_ID
+    tree = load_tree(args.source)
+    converter = CustomToDoctreenConverter(args.owner_id or DEFAULT_OWNER_ID, args.tree_name)
+    _, _, link = converter.convert_custom_to_doctreen(tree, tree_id=args.update_tree_id)
+    print(f"Published {len(tree)} nodes: {link}")
+
+
+if __name__ == "__main__":
+    main()
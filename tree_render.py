@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from metrics import get_tracer
+
+logger = logging.getLogger(__name__)
+
+SECTION_NAMES = {"INDICATION": "INDICATION", "TECHNICAL": "TECHNICAL", "TECHNIQUE": "TECHNICAL", "RESULT": "RESULT"}
+NODE_COLORS = {
+    'TYPE_TITLE': 'darkblue',
+    'TYPE_TOPIC': 'orange',
+    'TYPE_QUESTION': 'lightblue',
+    'TYPE_QCM': 'lightgreen',
+    'TYPE_QCS': 'lightpink',
+    'TYPE_MEASURE': 'yellow',
+    'TYPE_DATE': 'violet',
+    'TYPE_TEXT': 'tan',
+    'TYPE_OPERATION': 'cyan',
+    'TYPE_CALCULATION': 'magenta',
+    'TYPE_ROOT': 'red'
+}
+
+
+def node_color(node_type: str) -> str:
+    return NODE_COLORS.get(node_type, 'gray')
+
+
+def index_nodes(nodes) -> dict:
+    # plot_tree has always taken an {id: node} dict; run() returns a list.
+    return nodes if isinstance(nodes, dict) else {node["id"]: node for node in nodes}
+
+
+def find_roots(by_id: dict) -> list:
+    return [node_id for node_id, node in by_id.items() if not node.get("parent") or node["parent"]["id"] not in by_id]
+
+
+def find_root(by_id: dict, section: str = None):
+    roots = find_roots(by_id)
+    if section is None:
+        return roots[0] if roots else None
+    wanted = SECTION_NAMES.get(section.upper(), section.upper())
+    for root in roots:
+        for child in [root] + [child["id"] for child in by_id[root].get("childs", [])]:
+            text = by_id.get(child, {}).get("text", "").strip().rstrip(":").upper()
+            if SECTION_NAMES.get(text, text) == wanted:
+                return child
+    raise KeyError(f"no {section} section in the tree")
+
+
+def dot_source(nodes, root_id=None, section=None, max_depth=None) -> str:
+    # Node names are numbered in traversal order, so the same subtree always gives the same source
+    # whatever IDs it was generated with; the source is what the render cache is keyed on.
+    from graphviz import Digraph
+    by_id = index_nodes(nodes)
+    if root_id is not None or section is not None:
+        starts = [root_id if root_id is not None else find_root(by_id, section)]
+    else:
+        # Like plot_tree, the whole-tree view draws every root; without a depth limit it also draws
+        # nodes that no root reaches (cycles), so nothing in the tree is left out.
+        starts = find_roots(by_id) + (list(by_id) if max_depth is None else [])
+    dot = Digraph(comment='Combined Medical Tree')
+    names = {}
+    stack = [(start, 0) for start in reversed(starts)]
+    while stack:
+        node_id, depth = stack.pop()
+        if node_id in names or node_id not in by_id:
+            continue
+        node = by_id[node_id]
+        name = names[node_id] = f"n{len(names)}"
+        dot.node(name, label=node.get('text', node_id), style='filled', fillcolor=node_color(node.get('nodeType', '')))
+        children = [child["id"] for child in node.get('childs', []) if child["id"] in by_id]
+        if max_depth is not None and depth >= max_depth:
+            if children:
+                # Deeper levels are folded into one placeholder per node.
+                dot.node(f"{name}_more", label=f"+{len(children)} more", shape='note', style='dashed')
+                dot.edge(name, f"{name}_more")
+            continue
+        for child in reversed(children):
+            stack.append((child, depth + 1))
+    for node_id, name in names.items():
+        for child in by_id[node_id].get('childs', []):
+            if child["id"] in names and child["id"] != node_id:
+                dot.edge(name, names[child["id"]])
+    return dot.source
+
+
+def run_dot(source: str, fmt: str, timeout: float) -> bytes:
+    # dot runs in its own process, which is killed if the layout takes longer than the timeout.
+    try:
+        completed = subprocess.run(["dot", f"-T{fmt}"], input=source.encode("utf-8"), capture_output=True,
+                                   timeout=timeout, check=False)
+    except subprocess.TimeoutExpired:
+        raise TimeoutError(f"dot did not finish within {timeout}s") from None
+    if completed.returncode != 0:
+        raise RuntimeError(f"dot failed: {completed.stderr.decode('utf-8', 'replace').strip()}")
+    return completed.stdout
+
+
+class TreeRenderer:
+    # Renders whole trees, single sections or depth-limited views in the background. Rendered files
+    # are cached on disk under the hash of their DOT source, so an unchanged subtree is never laid out twice.
+    # The cache is kept under max_cache_bytes by removing the least recently used files.
+    def __init__(self, cache_dir="render_cache", max_workers=2, timeout=60, tracer=None, max_cache_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.max_cache_bytes = max_cache_bytes
+        self.tracer = tracer if tracer is not None else get_tracer()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="render")
+        self.pending = {}
+        # Re-entrant because a render that is already done runs its callback inside submit.
+        self._lock = threading.RLock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_path(self, source: str, fmt: str) -> str:
+        digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.{fmt}")
+
+    def _render(self, source, fmt, path):
+        with self.tracer.span("render", format=fmt, cached=False) as span:
+            output = run_dot(source, fmt, self.timeout)
+            span["bytes"] = len(output)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(output)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        # Oldest access first; a cache hit touches its file, so mtime is the last use.
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file() and not entry.name.endswith(".tmp") and entry.path != keep:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries) + (os.path.getsize(keep) if keep else 0)
+            for _, size, path in sorted(entries):
+                if total <= self.max_cache_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def submit(self, nodes, fmt="svg", root_id=None, section=None, max_depth=None):
+        # Returns a future of the rendered file's path. Identical requests share one future while it runs.
+        source = dot_source(nodes, root_id=root_id, section=section, max_depth=max_depth)
+        path = self.cache_path(source, fmt)
+        with self._lock:
+            future = self.pending.get(path)
+            if future is not None:
+                return future
+            if os.path.exists(path):
+                os.utime(path)
+                self.tracer.record("render", 0.0, format=fmt, cached=True)
+                future = Future()
+                future.set_result(path)
+            else:
+                future = self.pending[path] = self.executor.submit(self._render, source, fmt, path)
+                future.add_done_callback(lambda _: self._forget(path))
+        return future
+
+    def _forget(self, path):
+        with self._lock:
+            self.pending.pop(path, None)
+
+    def submit_sections(self, nodes, fmt="svg", max_depth=None) -> dict:
+        by_id = index_nodes(nodes)
+        futures = {}
+        for section in ("INDICATION", "TECHNICAL", "RESULT"):
+            try:
+                futures[section] = self.submit(by_id, fmt, section=section, max_depth=max_depth)
+            except KeyError:
+                logger.warning("No %s section to render", section)
+        return futures
+
+    def render(self, nodes, output_filename, fmt="png", **view) -> str:
+        # Blocking render to output_filename.<fmt>, for scripts that want the old plot_tree behaviour.
+        path = self.submit(nodes, fmt, **view).result()
+        output_path = f"{output_filename}.{fmt}"
+        with open(path, "rb") as src, open(output_path, "wb") as dst:
+            dst.write(src.read())
+        return output_path
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)